@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""Helpers shared by watson benchmarks."""
+
+import json
+import os
+import resource
+import socket
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """Returns a dict with given percentiles (and max) of the samples."""
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    result = {'max': samples[-1]}
+    for point in points:
+        index = min(len(samples) - 1, int(len(samples) * point / 100.0))
+        result['p%d' % point] = samples[index]
+
+    return result
+
+
+def memory_usage():
+    """Returns current and peak resident memory of this process in KiB."""
+    current = None
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                current = int(line.split()[1])
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'rss_kb': current, 'max_rss_kb': peak}
+
+
+def inotify_watch_count():
+    """Returns the number of inotify watches held by this process."""
+    count = 0
+    fd_dir = '/proc/self/fdinfo'
+    for fd in os.listdir(fd_dir):
+        try:
+            with open(os.path.join(fd_dir, fd)) as f:
+                count += sum(1 for l in f if l.startswith('inotify wd:'))
+        except IOError:
+            pass
+
+    return count
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def flatten(results, prefix=''):
+    """Flattens nested result dicts into {'a.b': value}."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+
+    return flat
+
+
+def compare(results, baseline_file, tolerance):
+    """Compares results with a stored baseline.
+
+    All metrics are "lower is better"; a metric regresses when it is worse
+    than the baseline by more than the tolerance (a fraction). Benchmark
+    parameters are stored under the 'parameters' key and are not compared.
+
+    Returns:
+        A list of (metric, baseline, value) tuples of regressed metrics.
+    """
+    with open(baseline_file) as f:
+        baseline = flatten(json.load(f))
+
+    regressions = []
+    for metric, value in sorted(flatten(results).items()):
+        if metric.startswith('parameters.'):
+            continue
+
+        expected = baseline.get(metric)
+        if not isinstance(expected, (int, float)) or value is None:
+            continue
+
+        if value > expected * (1 + tolerance):
+            regressions.append((metric, expected, value))
+
+    return regressions
+
+
+def save(results, baseline_file):
+    with open(baseline_file, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+        f.write('\n')
+
+
+def report(results, regressions):
+    for metric, value in sorted(flatten(results).items()):
+        print '%-40s %s' % (metric, value)
+
+    for metric, expected, value in regressions:
+        print 'REGRESSION %s: %s (baseline %s)' % (metric, value, expected)
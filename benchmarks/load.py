@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+"""Load and scaling benchmark of the watson server.
+
+Generates synthetic project trees in a temporary directory, registers them
+with a real WatsonServer (running in this process, on a free port) and
+replays file events against them. Builds are recorded instead of executed,
+so the numbers describe watson itself: event-to-build latency, event storm
+handling, memory, inotify watches and API round-trip times.
+
+Usage:
+
+    python benchmarks/load.py [--projects 100] [--files 1000] ...
+
+Results are compared with benchmarks/baseline-load.json (when it was
+recorded with the same parameters) and the script exits with 1 on
+regressions. Use --save to record a new baseline.
+"""
+
+import collections
+import json
+import logging
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import xmlrpclib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import common
+from watson import core
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline-load.json')
+
+
+class RecordingBuilder(core.ProjectBuilder):
+    """Records when builds start instead of executing scripts."""
+
+    def __init__(self):
+        super(RecordingBuilder, self).__init__()
+        self.builds = collections.defaultdict(list)
+        self._condition = threading.Condition()
+
+    def execute_script(self, working_dir, script, warm_runner=False,
+                       changes=None):
+        with self._condition:
+            self.builds[unicode(working_dir)].append(time.time())
+            self._condition.notify_all()
+
+        return (True, None)
+
+    def count(self):
+        with self._condition:
+            return sum(len(b) for b in self.builds.itervalues())
+
+    def wait_for_build(self, working_dir, since, timeout=10):
+        """Returns the start time of the first build after given time."""
+        deadline = time.time() + timeout
+        with self._condition:
+            while time.time() < deadline:
+                for start in self.builds[working_dir]:
+                    if start >= since:
+                        return start
+
+                self._condition.wait(deadline - time.time())
+
+    def wait_until_idle(self, quiet=0.5, timeout=60):
+        """Waits until no build has started for a while."""
+        deadline = time.time() + timeout
+        count = self.count()
+        while time.time() < deadline:
+            time.sleep(quiet)
+            if self.count() == count:
+                break
+            count = self.count()
+
+
+def generate_projects(root, projects, files, files_per_dir):
+    """Generates project trees; returns a list of project directories."""
+    directories = []
+    for p in range(projects):
+        project_dir = os.path.join(root, 'project%05d' % p)
+        for f in range(files):
+            directory = os.path.join(
+                project_dir, 'dir%05d' % (f // files_per_dir))
+            if f % files_per_dir == 0:
+                os.makedirs(directory)
+
+            with open(os.path.join(directory, 'file%05d.py' % f), 'w') as fd:
+                fd.write('# %d\n' % f)
+
+        directories.append(unicode(project_dir))
+
+    return directories
+
+
+def touch(project_dir, n):
+    with open(os.path.join(project_dir, 'changed%d.py' % (n % 10)), 'w') as f:
+        f.write('# %d\n' % n)
+
+
+def run(options):
+    root = tempfile.mkdtemp(prefix='watson-benchmark-')
+    results = {'parameters': {
+        'projects': options.projects, 'files': options.files,
+        'files_per_dir': options.files_per_dir, 'samples': options.samples,
+        'storm_events': options.storm_events,
+        'storm_rate': options.storm_rate}}
+
+    try:
+        start = time.time()
+        projects = generate_projects(root, options.projects, options.files,
+                                     options.files_per_dir)
+        logging.warning('Generated %d projects in %.1fs', len(projects),
+                        time.time() - start)
+
+        memory_before = common.memory_usage()
+        watches_before = common.inotify_watch_count()
+
+        endpoint = 'localhost:%d' % common.free_port()
+        server = core.WatsonServer({'endpoint': endpoint, 'build_timeout': 0,
+                                    'notification_sinks': []})
+        builder = server._builder = RecordingBuilder()
+        thread = threading.Thread(target=server._start)
+        thread.start()
+
+        client = xmlrpclib.ServerProxy('http://%s/' % endpoint,
+                                       allow_none=True)
+
+        try:
+            results.update(measure(options, client, builder, projects))
+        finally:
+            results['inotify_watches'] = (common.inotify_watch_count() -
+                                          watches_before)
+            memory = common.memory_usage()
+            results['memory'] = {
+                'rss_kb': memory['rss_kb'] - memory_before['rss_kb'],
+                'max_rss_kb': memory['max_rss_kb']}
+
+            server._join()
+            server.shutdown()
+            thread.join()
+    finally:
+        shutil.rmtree(root)
+
+    return results
+
+
+def measure(options, client, builder, projects):
+    results = {}
+
+    # API round-trip times
+    samples = []
+    for _ in range(options.samples):
+        start = time.time()
+        client.hello()
+        samples.append(time.time() - start)
+    results['api_hello_s'] = common.percentiles(samples)
+
+    samples = []
+    for project_dir in projects:
+        start = time.time()
+        client.add_project(project_dir, {'script': ['true']})
+        samples.append(time.time() - start)
+    results['api_add_project_s'] = common.percentiles(samples)
+
+    # Let the initial builds and watches settle down
+    builder.wait_until_idle()
+
+    # Event-to-build latency of single changes
+    samples = []
+    for n in range(options.samples):
+        project_dir = projects[n % len(projects)]
+        start = time.time()
+        touch(project_dir, n)
+        build = builder.wait_for_build(project_dir, start)
+        if build is not None:
+            samples.append(build - start)
+        builder.wait_until_idle(quiet=0.05)
+
+    results['event_to_build_s'] = common.percentiles(samples)
+    results['missed_builds'] = options.samples - len(samples)
+
+    # Event storm spread over all projects at a given rate
+    builds = builder.count()
+    interval = 1.0 / options.storm_rate
+    start = time.time()
+    for n in range(options.storm_events):
+        touch(projects[n % len(projects)], n)
+        delay = start + n * interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    storm_end = time.time()
+
+    builder.wait_until_idle()
+    last_build = max(max(b) for b in builder.builds.itervalues())
+    results['storm'] = {
+        'write_s': storm_end - start,
+        'drain_s': max(last_build - storm_end, 0),
+        'builds': builder.count() - builds,
+    }
+
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option('--projects', type='int', default=20)
+    parser.add_option('--files', type='int', default=100,
+                      help='number of files in each project')
+    parser.add_option('--files-per-dir', type='int', default=100)
+    parser.add_option('--samples', type='int', default=100)
+    parser.add_option('--storm-events', type='int', default=10000)
+    parser.add_option('--storm-rate', type='int', default=10000,
+                      help='target file writes per second')
+    parser.add_option('--tolerance', type='float', default=0.5,
+                      help='allowed regression as a fraction of baseline')
+    parser.add_option('--baseline', default=BASELINE_FILE)
+    parser.add_option('--save', action='store_true',
+                      help='save results as the new baseline')
+    options, _ = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(options)
+
+    regressions = []
+    if options.save:
+        common.save(results, options.baseline)
+    elif os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            parameters = json.load(f).get('parameters')
+
+        if parameters == results['parameters']:
+            regressions = common.compare(results, options.baseline,
+                                         options.tolerance)
+        else:
+            logging.warning('Baseline was recorded with different '
+                            'parameters: %s', parameters)
+
+    common.report(results, regressions)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""Memory benchmark of watched projects.
+
+Registers thousands of projects with a WatsonServer (running in this process,
+without its API loop) and builds each of them once with a synthetic failing
+output, then reports resident memory per project. A null observer is used, so
+the numbers describe watson's own structures; see load.py for inotify.
+
+Usage:
+
+    python benchmarks/memory.py [--projects 1000,5000] [--configs 10] ...
+
+Results are compared with benchmarks/baseline-memory.json (when it was
+recorded with the same parameters) and the script exits with 1 on
+regressions. Use --save to record a new baseline.
+"""
+
+import gc
+import json
+import logging
+import optparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import common
+from watson import core
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__),
+                             'baseline-memory.json')
+
+
+class NullObserver(object):
+
+    def schedule(self, handler, path, recursive=False):
+        return object()
+
+    def unschedule(self, watch):
+        pass
+
+
+class FailingBuilder(core.ProjectBuilder):
+    """Returns the same nose-like failing output instead of building."""
+
+    def __init__(self, lines):
+        super(FailingBuilder, self).__init__()
+        output = []
+        for n in range(lines // 10):
+            output.extend([
+                '=' * 70,
+                'FAIL: test_%d (project.module_test.TestCase)' % n,
+                '-' * 70,
+                'Traceback (most recent call last):',
+                '  File "project/module_test.py", line %d, in test_%d' % (
+                    n, n),
+                '    self.assertEqual(%d, result)' % n,
+                'AssertionError: %d != %d' % (n, n + 1),
+                '', '', ''])
+        self._output = '\n'.join(output)
+
+    def execute_script(self, working_dir, script, warm_runner=False,
+                       changes=None):
+        # Every project gets its own copy, as real builds would
+        result = core.make_result(script[-1], 1, self._output + ' ', '')
+        return (False, result)
+
+
+def run(options):
+    counts = sorted(int(c) for c in options.projects.split(','))
+    results = {'parameters': {
+        'projects': options.projects, 'configs': options.configs,
+        'output_lines': options.output_lines}}
+
+    server = core.WatsonServer({
+        'endpoint': 'localhost:%d' % common.free_port(),
+        'notification_sinks': [], 'initial_builds': 0})
+    server._observer = NullObserver()
+    server._builder = FailingBuilder(options.output_lines)
+
+    per_project = {}
+    rss = {}
+    try:
+        gc.collect()
+        before = common.memory_usage()['rss_kb']
+
+        added = 0
+        for count in counts:
+            projects = [
+                ('/nonexistent/watson-benchmark/project%05d' % n,
+                 {'script': ['nosetests'], 'ignore': ['.git/.*', '.*.pyc'],
+                  'priority': n % options.configs})
+                for n in range(added, count)]
+            server.add_projects(projects)
+            for working_dir, _ in projects:
+                server._projects[working_dir].build()
+            added = count
+
+            gc.collect()
+            rss[str(count)] = common.memory_usage()['rss_kb'] - before
+            per_project[str(count)] = rss[str(count)] / float(count)
+            logging.warning('%d projects: %d KiB', count, rss[str(count)])
+    finally:
+        # Server threads have not been started
+        server._api.server_close()
+
+    results['rss_kb'] = rss
+    results['per_project_kb'] = per_project
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option('--projects', default='1000,5000',
+                      help='comma separated numbers of projects')
+    parser.add_option('--configs', type='int', default=10,
+                      help='number of distinct project configs')
+    parser.add_option('--output-lines', type='int', default=500,
+                      help='lines of output of every build')
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help='allowed regression as a fraction of baseline')
+    parser.add_option('--baseline', default=BASELINE_FILE)
+    parser.add_option('--save', action='store_true',
+                      help='save results as the new baseline')
+    options, _ = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(options)
+
+    regressions = []
+    if options.save:
+        common.save(results, options.baseline)
+    elif os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            parameters = json.load(f).get('parameters')
+
+        if parameters == results['parameters']:
+            regressions = common.compare(results, options.baseline,
+                                         options.tolerance)
+        else:
+            logging.warning('Baseline was recorded with different '
+                            'parameters: %s', parameters)
+
+    common.report(results, regressions)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
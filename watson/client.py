@@ -10,12 +10,16 @@ import xmlrpclib
 
 from . import core
 from . import daemon
+from . import worker
 
 
 class WatsonClient(xmlrpclib.ServerProxy):
 
     def __init__(self):
-        self.endpoint = ('localhost', 0x221B)
+        # Connect where the server listens
+        config = core.Config(
+            core.load_config_safe(core.DEFAULT_GLOBAL_CONFIG_FILE))
+        self.endpoint = core.parse_endpoint(config['endpoint'])
         xmlrpclib.ServerProxy.__init__(self, 'http://%s:%s/' % self.endpoint,
                                        allow_none=True)
 
@@ -34,9 +38,23 @@ class WatsonClient(xmlrpclib.ServerProxy):
         # TODO(dejw): write a test for marshaling path.path objects
         self.add_project(unicode(project_dir), config)
 
+    def watch_recursive(self, directory="."):
+        """Starts watching all projects under a directory in one call.
+
+        Returns:
+            The number of found projects
+        """
+        projects = core.find_projects(path.path(directory).abspath())
+        if not projects:
+            raise core.WatsonError('no projects found under %s' % directory)
+
+        self.add_projects([(unicode(project_dir), core.load_config(config))
+                           for project_dir, config in projects])
+        return len(projects)
+
 
 def main():
-    """usage: watson watch
+    """usage: watson watch [--recursive directory]|worker [host:port]
 
     Repository watcher - watches for filesystem changes of your project and
     constantly builds it and keeps you posted about the build status.
@@ -44,7 +62,13 @@ def main():
     Commands:
 
       watch     starts watching a project or updates its status if it was
-                already being watched
+                already being watched; with --recursive, watches all
+                projects found under a directory (their initial builds
+                are staggered, see `initial_builds` config)
+      worker    runs a worker agent, which builds projects on behalf of
+                watson servers that registered it (see `workers` config);
+                it executes any command it is sent, so let it listen only
+                on localhost or a trusted network
 
     """
     if len(sys.argv) < 2:
@@ -74,7 +98,32 @@ def main():
                                        'server at %s' % (client.endpoint,))
         logging.info('Connected to %s' % version)
 
-        client.watch()
+        arguments = sys.argv[2:]
+        if arguments[:1] in (['-r'], ['--recursive']):
+            count = client.watch_recursive(*arguments[1:2])
+            logging.info('Watching %d projects', count)
+        else:
+            client.watch()
+
+    if command == 'worker':
+        run_worker(*sys.argv[2:3])
+
+
+def run_worker(endpoint=None):
+    config = core.Config(
+        core.load_config_safe(core.DEFAULT_GLOBAL_CONFIG_FILE))
+    logging.basicConfig(level=config['log_level'].upper(),
+                        format='%(levelname)7s: %(message)s')
+
+    agent = worker.WorkerAgent(
+        core.parse_endpoint(endpoint or config['worker_endpoint']),
+        path.path(config['worker_root']).expand())
+    try:
+        agent._start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.shutdown()
 
 if __name__ == '__main__':
     main()
@@ -32,6 +32,32 @@ class TestWatsonClient(test_helper.TestBase):
 
         self.mox.VerifyAll()
 
+    def test_watch_recursive(self):
+        fixtures = (path.path(__file__).dirname() / '../fixtures').abspath()
+        project_dir = fixtures / 'project1'
+
+        cl = client.WatsonClient()
+        cl.add_projects = self.mox.CreateMockAnything()
+        cl.add_projects([(unicode(project_dir), core.load_config(
+            project_dir / core.CONFIG_FILENAMES[0]))])
+
+        self.mox.ReplayAll()
+
+        self.assertEqual(1, cl.watch_recursive(fixtures))
+
+        self.mox.VerifyAll()
+
+    def test_endpoint_from_global_config(self):
+        self.mox.StubOutWithMock(core, 'load_config_safe')
+        core.load_config_safe(core.DEFAULT_GLOBAL_CONFIG_FILE).AndReturn(
+            {'endpoint': 'example.com:9000'})
+        self.mox.ReplayAll()
+
+        cl = client.WatsonClient()
+
+        self.mox.VerifyAll()
+        self.assertEqual(('example.com', 9000), cl.endpoint)
+
     def test_watch_raise_WatsonError_without_config(self):
         cl = client.WatsonClient()
         working_dir = (path.path(__file__).dirname()
@@ -3,14 +3,20 @@
 from __future__ import absolute_import
 
 import atexit
+import collections
+import json
 import logging
 import os
 import path
+import random
 import re
 import SimpleXMLRPCServer
 import sched
+import socket
 import threading
 import time
+import weakref
+import xmlrpclib
 import yaml
 
 from fabric import context_managers
@@ -18,20 +24,51 @@ from fabric import decorators
 from fabric import operations
 from multiprocessing import pool
 from stuf import collects
-from watchdog import events
 from watchdog import observers
 
 from . import __version__
+from . import notify
+from . import results
+from . import trace
+from . import warm
+from . import worker
 
 
 CONFIG_FILENAMES = ['.watson.yaml', '.watson.yml']
 DEFAULT_PROJECT_INDICATORS = ['.vip', 'setup.py'] + CONFIG_FILENAMES
 
 DEFAULT_GLOBAL_CONFIG_FILE = path.path('~/.watson/config.yaml').expand()
+
+# How long to wait for other changes before the server state is saved
+SNAPSHOT_DELAY = 1
+
+# Upper limit of profile() duration; API calls are blocked in the meantime
+MAX_PROFILE_SECONDS = 60
+
+# How long a worker agent which failed a build is not used
+WORKER_RETRY_DELAY = 30
+
+# Keys which affect the result of a build
+BUILD_CONFIG_KEYS = ['script', 'warm_runner']
+
 DEFAULT_CONFIG = {
     'endpoint': 'localhost:%s' % 0x221B,
     'ignore': ['.git/.*', '.*.pyc'],
-    'build_timeout': 3
+    'build_timeout': 3,
+    'priority': 0,
+    'warm_runner': False,
+    'notification_sinks': ['desktop'],
+    'notification_interval': 2,
+    'notification_lines': 20,
+    'log_level': 'info',
+    'trace_sample_rate': 0.01,
+    'trace_buffer_size': 1000,
+    'shards': 1,
+    'initial_builds': 2,
+    'initial_build_delay': 1,
+    'workers': [],
+    'worker_endpoint': 'localhost:%s' % (0x221B + 0x100),
+    'worker_root': '~/.watson/worker'
 }
 
 
@@ -71,11 +108,74 @@ def find_project_directory(start=".", look_for=None):
     raise WatsonError('%s does not look like a project subdirectory' % start)
 
 
+def find_projects(directory):
+    """Finds projects (directories with a config file) under a tree.
+
+    Hidden directories and the ones inside of found projects are skipped.
+
+    Returns:
+        A list of (project directory, config file) tuples
+    """
+    projects = []
+    for root, dirs, files in os.walk(directory):
+        config_files = [n for n in CONFIG_FILENAMES if n in files]
+        if config_files:
+            root = path.path(root)
+            projects.append((root, root / config_files[0]))
+            dirs[:] = []
+        else:
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+
+    return projects
+
+
 def get_project_name(working_dir):
     """Returns a project name from given working directory."""
     return path.path(working_dir).name
 
 
+class _Patterns(list):
+    """Compiled patterns; unlike tuples, lists can be weakly referenced."""
+
+    __slots__ = ['__weakref__']
+
+
+# Only patterns in use are kept, so edited ignore lists do not pile up
+_PATTERNS = weakref.WeakValueDictionary()
+
+
+def compile_patterns(patterns):
+    """Compiles regexps; the same lists of patterns are compiled only once."""
+    key = tuple(patterns)
+    compiled = _PATTERNS.get(key)
+    if compiled is None:
+        compiled = _PATTERNS[key] = _Patterns(re.compile(p) for p in key)
+
+    return compiled
+
+
+def is_debug_enabled():
+    """Checks if debug logging is enabled, to guard hot paths."""
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+def parse_endpoint(endpoint):
+    """Parses 'host:port' string into a (host, port) tuple."""
+    host, _, port = endpoint.rpartition(':')
+    return (host or 'localhost', int(port))
+
+
+def make_result(command, return_code, stdout, stderr):
+    """Returns a result which looks like the one of operations.local."""
+    result = operations._AttributeString(stdout)
+    result.stderr = operations._AttributeString(stderr)
+    result.command = result.real_command = command
+    result.return_code = return_code
+    result.failed = return_code != 0
+    result.succeeded = not result.failed
+    return result
+
+
 def load_config(config_file):
     logging.info('Loading config: %s', config_file)
     config_file = path.path(config_file).abspath()
@@ -97,6 +197,39 @@ def load_config_safe(config_file):
         return {}
 
 
+class StateStore(object):
+    """Keeps a JSON state in a file which is replaced atomically."""
+
+    def __init__(self, filename):
+        self.filename = path.path(filename)
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Returns the saved state or None if it is missing or broken."""
+        if not self.filename.exists():
+            return None
+
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            logging.error('Could not load state from %s: %s',
+                          self.filename, e)
+            return None
+
+    def save(self, state):
+        with self._lock:
+            self.filename.parent.makedirs_p()
+
+            temporary = self.filename + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.rename(temporary, self.filename)
+
+
 class EventScheduler(threading.Thread):
 
     def __init__(self):
@@ -116,13 +249,24 @@ class EventScheduler(threading.Thread):
             return self._is_finished
 
     def schedule(self, event, delay, function):
-        with self._condition:
-            logging.info('Scheduling %s in %ss', function.__name__, delay)
+        with trace.span('scheduler_lock'):
+            self._condition.acquire()
+
+        try:
+            if is_debug_enabled():
+                logging.debug('Scheduling %s in %ss', function.__name__,
+                              delay)
             if event is not None:
-                self._sched.cancel(event)
+                try:
+                    self._sched.cancel(event)
+                except ValueError:
+                    # The event has just been popped to be run
+                    pass
 
             self._condition.notify()
             return self._sched.enter(delay, 1, function, [])
+        finally:
+            self._condition.release()
 
     def stop(self):
         with self._condition:
@@ -150,12 +294,194 @@ class EventScheduler(threading.Thread):
         logging.info('Event scheduler stopped')
 
 
+class BuildQueue(threading.Thread):
+    """Runs due builds, the most important project first.
+
+    Projects are ranked by being in the foreground (the one that was most
+    recently watched or edited), then by their configured priority and
+    finally by recency of their last change. While the foreground project
+    waits for its own build, builds of other projects are held back.
+
+    Builds run one at a time, or as many as `capacity` returns (e.g. one per
+    worker agent), but a project is never built twice at once.
+    """
+
+    def __init__(self, on_build=None, capacity=None):
+        threading.Thread.__init__(self)
+        self._on_build = on_build
+        self._capacity = capacity or (lambda: 1)
+        self._pending = set()
+        self._building = set()
+        self._foreground = None
+        self._is_finished = False
+        self._condition = threading.Condition()
+        self._join_event = threading.Event()
+
+    @property
+    def is_finished(self):
+        with self._condition:
+            return self._is_finished
+
+    def activate(self, project):
+        """Moves given project to the foreground."""
+        with self._condition:
+            self._foreground = project
+            self._condition.notify()
+
+    def put(self, project):
+        with self._condition:
+            self._pending.add(project)
+            self._condition.notify()
+
+    def discard(self, project):
+        with self._condition:
+            self._pending.discard(project)
+            if self._foreground is project:
+                self._foreground = None
+
+    def rank(self, project):
+        return (project is self._foreground, project.priority,
+                project.last_changed)
+
+    def stop(self):
+        with self._condition:
+            logging.info('Stopping build queue')
+            self._is_finished = True
+            self._pending.clear()
+            self._condition.notify()
+
+    def join(self, timeout=None):
+        self._join_event.wait(timeout)
+
+    def _hold_timeout(self):
+        """Returns for how long background builds should be held back."""
+        foreground = self._foreground
+        if foreground is None or foreground in self._pending:
+            return None
+
+        due = foreground.build_due
+        if due is None:
+            return None
+
+        return max(due - time.time(), 0) or None
+
+    def _pop(self):
+        """Waits for a project to build and marks it as being built."""
+        with self._condition:
+            while not self._is_finished:
+                timeout = self._hold_timeout()
+                ready = self._pending - self._building
+                if (ready and timeout is None and
+                        len(self._building) < self._capacity()):
+                    project = max(ready, key=self.rank)
+                    self._pending.remove(project)
+                    self._building.add(project)
+                    return project
+
+                self._condition.wait(timeout)
+
+    def _done(self, project):
+        with self._condition:
+            self._building.discard(project)
+            self._condition.notify_all()
+
+    def _build(self, project):
+        try:
+            project.build()
+        except Exception:
+            logging.exception('Build of %s crashed', project.name)
+        finally:
+            self._done(project)
+
+        if self._on_build is not None:
+            self._on_build(project)
+
+    def run(self):
+        logging.info('Starting build queue')
+
+        while True:
+            project = self._pop()
+            if project is None:
+                break
+
+            builder = threading.Thread(target=self._build, args=(project,))
+            builder.daemon = True
+            builder.start()
+
+        # Let builds in progress finish
+        with self._condition:
+            while self._building:
+                self._condition.wait()
+
+        self._join_event.set()
+        logging.info('Build queue stopped')
+
+
+class InitialBuilds(object):
+    """Staggers initial builds of projects added in bulk or restored.
+
+    At most `limit` of them are in progress at once and they are started at
+    least `delay` seconds apart, so registering many projects does not build
+    them all at the same time. With zero limit they are deferred until the
+    projects change.
+    """
+
+    def __init__(self, limit, delay):
+        self.limit = limit
+        self.delay = delay
+        self._waiting = collections.deque()
+        self._running = set()
+        self._next_start = 0
+        self._lock = threading.Lock()
+
+    def add(self, project):
+        with self._lock:
+            if project not in self._running and project not in self._waiting:
+                self._waiting.append(project)
+            self._start_next()
+
+    def done(self, project):
+        """Called after every build, so the next initial build can start."""
+        with self._lock:
+            self._running.discard(project)
+            if project in self._waiting:
+                # It has been built, because it has changed in the meantime
+                self._waiting.remove(project)
+            self._start_next()
+
+    def _start_next(self):
+        while self._waiting and len(self._running) < self.limit:
+            project = self._waiting.popleft()
+            self._running.add(project)
+
+            now = time.time()
+            start = max(now, self._next_start)
+            self._next_start = start + self.delay
+            project.schedule_build(start - now)
+
+
+class Changes(object):
+    """Relative paths of a project which changed since its last build.
+
+    Paths are of files, except for directories moved as a whole.
+    """
+
+    __slots__ = ['paths', 'list_files', 'is_ignored']
+
+    def __init__(self, list_files, is_ignored):
+        self.paths = set()
+        self.list_files = list_files
+        self.is_ignored = is_ignored
+
+
 class Config(collects.ChainMap):
 
-    _KEYS_TO_WRAP = ['ignore', 'script']
+    _KEYS_TO_WRAP = ['ignore', 'script', 'notification_sinks']
 
     def __init__(self, *configs):
         super(Config, self).__init__(*configs)
+        self._parent = None
+        self._children = weakref.WeakValueDictionary()
 
     def __missing__(self, item):
         return DEFAULT_CONFIG[item]
@@ -169,39 +495,79 @@ class Config(collects.ChainMap):
         return value
 
     def push(self, config):
-        new_config = self.new_child()
-        new_config.update(config)
-        return new_config
+        """Returns a child config with given settings on top of this one.
+
+        Children with the same settings are shared, so projects configured
+        alike do not keep their own copies. Shared configs are not modified.
+        """
+        key = json.dumps(config, sort_keys=True, default=repr)
+        child = self._children.get(key)
+        if child is None:
+            child = self.new_child()
+            child.update(config)
+            child._parent = self
+            self._children[key] = child
+
+        return child
 
     def replace(self, config):
-        self.maps[0] = config
+        """Returns a config like this one, but with own settings replaced."""
+        if self._parent is not None:
+            return self._parent.push(config)
+
+        return self.__class__(config, *self.maps[1:])
+
+    def get_effective(self, item):
+        """Returns a value of given item or None if it is not set at all."""
+        try:
+            return self[item]
+        except KeyError:
+            return None
 
     def __getattr__(self, attr):
         return self.__getitem__(attr)
 
 
-class ProjectWatcher(events.FileSystemEventHandler):
+class ProjectWatcher(object):
+    """Watches a project and builds it when its files change.
+
+    Servers may watch thousands of projects, so watchers are kept compact:
+    they use slots, share configs and compiled ignore patterns with other
+    projects, and keep only a bounded summary of the last build.
+    """
 
     # TODO(dejw): should expose some stats (like how many times it was
     #             notified) or how many times it succeeed in testing etc.
 
-    def __init__(self, config, working_dir, scheduler, builder, observer):
-        super(ProjectWatcher, self).__init__()
+    __slots__ = ['_event', '_build', '_build_started', 'last_changed',
+                 'working_dir', '_config', '_ignore', '_summary', '_notifier',
+                 '_changes', '_scheduler', '_builder', '_observer',
+                 '_build_queue', '_watch']
+
+    # Changes are swapped in a blink, so all projects share a single lock
+    _changes_lock = threading.Lock()
 
+    def __init__(self, config, working_dir, scheduler, builder, observer,
+                 build_queue=None, notifier=None):
         self._event = None
         self._build = 0
+        self._build_started = None
+        self.last_changed = time.time()
 
-        self.name = get_project_name(working_dir)
         self.working_dir = path.path(working_dir)
-        self.set_config(config)
+        self._config = config
+        self._compile_ignore()
 
-        self._last_status = (None, None)
-        self._notification = None
-        self._create_notification()
+        self._summary = None
+        self._notifier = notifier
+
+        # Created on the first change
+        self._changes = None
 
         self._scheduler = scheduler
         self._builder = builder
         self._observer = observer
+        self._build_queue = build_queue
 
         # TODO(dejw): allow to change observing patterns (and recursiveness)
         self._watch = observer.schedule(self, path=working_dir, recursive=True)
@@ -211,31 +577,205 @@ class ProjectWatcher(events.FileSystemEventHandler):
     def __repr__(self):
         return '<ProjectWatcher %s(%s)>' % (self.name, self.working_dir)
 
+    @property
+    def name(self):
+        return get_project_name(self.working_dir)
+
     @property
     def script(self):
         return self._config['script']
 
-    def set_config(self, config):
-        logging.info('New config for %s', self.name)
-        self._config = config
+    @property
+    def priority(self):
+        return self._config['priority']
+
+    @property
+    def build_due(self):
+        """Time when the scheduled build is due or None."""
+        event = self._event
+        return event.time if event is not None else None
+
+    def update_config(self, config):
+        """Replaces project's own config and applies only what has changed.
+
+        The new config is shared with projects configured alike (see
+        Config.replace), and the depth of its chain stays the same.
+
+        Returns:
+            A set of keys which effective values have changed.
+        """
+        keys = set(self._config.maps[0]) | set(config)
+        before = dict((k, self._config.get_effective(k)) for k in keys)
+        self._config = self._config.replace(config)
+        changed = set(k for k in keys
+                      if self._config.get_effective(k) != before[k])
+
+        logging.info('New config for %s; changed: %s', self.name,
+                     ', '.join(sorted(changed)) or 'nothing')
+
+        if 'ignore' in changed:
+            self._compile_ignore()
+
+        if 'build_timeout' in changed and self._event is not None:
+            self.schedule_build()
+
+        return changed
+
+    def _compile_ignore(self):
+        self._ignore = compile_patterns(self._config['ignore'])
+
+    def _reload_config(self, config_file):
+        """Reloads the config file.
+
+        Returns:
+            Whether the change requires a new build.
+        """
+        try:
+            changed = self.update_config(load_config(config_file))
+        except (WatsonError, yaml.YAMLError) as e:
+            logging.error('Keeping old config of %s: %s', self.name, e)
+            return False
+
+        return bool(changed.intersection(BUILD_CONFIG_KEYS))
+
+    def snapshot(self):
+        """Returns a JSON-serializable state of the project."""
+        return {'working_dir': unicode(self.working_dir),
+                'config': self._config.maps[0],
+                'build': self._build,
+                'succeeded': self.succeeded,
+                'failures': self._failure_names(),
+                'build_started': self._build_started,
+                'pending': (self._event is not None or
+                            self._changes is not None)}
+
+    def status(self):
+        """Returns a short status of the project."""
+        return {'name': unicode(self.name),
+                'working_dir': unicode(self.working_dir),
+                'build': self._build,
+                'succeeded': self.succeeded,
+                'failures': self._failure_names(),
+                'failure_count': self._summary.failure_count
+                if self._summary else 0,
+                'new_failures': list(self._summary.new_failures)
+                if self._summary else [],
+                'fixed': list(self._summary.fixed) if self._summary else [],
+                'scheduled': self._event is not None}
+
+    def restore(self, state):
+        """Restores the build counter and status from a snapshot."""
+        self._build = state['build']
+        self._build_started = state.get('build_started')
+        self._summary = results.Summary(
+            state['build'], state['succeeded'],
+            [results.Failure(name, '') for name in state.get('failures', [])])
+
+    @property
+    def succeeded(self):
+        return self._summary.succeeded if self._summary else None
+
+    @property
+    def log(self):
+        """The output of the last build."""
+        return self._summary.log if self._summary else ''
+
+    def _failure_names(self):
+        if self._summary is None:
+            return []
+        return self._summary.failures
+
+    def is_modified_since(self, timestamp):
+        """Checks if any not ignored file was modified after given time.
+
+        Directories are checked as well, so removed files are detected too.
+        """
+        for _, full_path, _ in self._walk():
+            try:
+                if os.stat(full_path).st_mtime > timestamp:
+                    return True
+            except OSError:
+                return True
+
+        return False
+
+    def list_files(self):
+        """Returns relative paths of all not ignored files."""
+        return [relative for relative, _, is_file in self._walk() if is_file]
+
+    def _walk(self):
+        """Yields (relative path, full path, is file) of not ignored items."""
+        for root, dirs, files in os.walk(self.working_dir):
+            relative_root = root[len(self.working_dir):].lstrip('/')
+            yield relative_root, root, False
+
+            dirs[:] = [d for d in dirs if not self._is_ignored(
+                os.path.join(relative_root, d) + '/')]
+
+            for name in files:
+                relative = os.path.join(relative_root, name)
+                if not self._is_ignored(relative):
+                    yield relative, os.path.join(root, name), True
+
+    def _is_ignored(self, relative_path):
+        return self._match_ignore(relative_path) is not None
+
+    def _match_ignore(self, relative_path):
+        """Returns the first ignore pattern matching given path or None."""
+        for ignore in self._ignore:
+            if ignore.match(relative_path):
+                return ignore
 
     def shutdown(self):
         logging.info('Shuting down project: %r', self)
         self._hide_notification()
         self._observer.unschedule(self._watch)
+        if self._build_queue is not None:
+            self._build_queue.discard(self)
+
+    def dispatch(self, event):
+        """Called by the observer for every event."""
+        with trace.span('dispatch'):
+            self.on_any_event(event)
 
     def on_any_event(self, event):
+        # Changes in directories are reported for their files as well, but
+        # moved directories are not
+        dest_path = getattr(event, 'dest_path', None)
+        if getattr(event, 'is_directory', False) and not dest_path:
+            return
+
+        debug = is_debug_enabled()
         event_path = event.src_path[len(self.working_dir):].lstrip('/')
-        for ignore in self._config['ignore']:
-            if re.match(ignore, event_path):
+
+        with trace.span('ignore'):
+            ignore = self._match_ignore(event_path)
+
+        if ignore is not None:
+            if debug:
                 logging.debug('%s Matched %s pattern; skipping',
-                              event_path, ignore)
-                return
+                              event_path, ignore.pattern)
+            return
+
+        with self._changes_lock:
+            if self._changes is None:
+                self._changes = Changes(self.list_files, self._is_ignored)
+            self._changes.paths.add(event_path)
+            if dest_path:
+                dest_path = dest_path[len(self.working_dir):].lstrip('/')
+                if not self._is_ignored(dest_path):
+                    self._changes.paths.add(dest_path)
 
         # Automatically pickup config changes
-        logging.debug(event_path)
-        if event_path in CONFIG_FILENAMES:
-            self._config.replace(load_config(event.src_path))
+        if debug:
+            logging.debug(event_path)
+        if (event_path in CONFIG_FILENAMES and
+                not self._reload_config(event.src_path)):
+            return
+
+        self.last_changed = time.time()
+        if self._build_queue is not None:
+            self._build_queue.activate(self)
 
         self.schedule_build()
 
@@ -245,63 +785,80 @@ class ProjectWatcher(events.FileSystemEventHandler):
         if timeout is None:
             timeout = self._config['build_timeout']
 
-        logging.debug('Scheduling a build in %ss', timeout)
         self._event = self._scheduler.schedule(
-            self._event, timeout, self.build)
+            self._event, timeout, self._enqueue_build)
+
+    def _enqueue_build(self):
+        """Hands the project over to the build queue, or builds it."""
+        if self._build_queue is None:
+            self.build()
+        else:
+            self._event = None
+            self._build_queue.put(self)
 
     def build(self):
         """Builds the project and shows notification on result."""
         logging.info('Build %s of %s (%s)', self._build, self.name,
                      self.working_dir)
         self._build += 1
+        self._build_started = time.time()
         self._event = None
-        status = self._builder.execute_script(self.working_dir, self.script)
-        self._show_notification(status)
 
-    def _create_notification(self):
-        try:
-            import pynotify
-            self._notification = pynotify.Notification('')
-            self._notification.set_timeout(3)
-        except ImportError:
-            pass
+        with self._changes_lock:
+            changes, self._changes = self._changes, None
+        if changes is None:
+            changes = Changes(self.list_files, self._is_ignored)
 
-    def _hide_notification(self):
-        if self._notification is None:
-            return
+        with trace.span('build'):
+            status = self._builder.execute_script(
+                self.working_dir, self.script, self._config['warm_runner'],
+                changes)
 
-        self._notification.close()
+        # Only a summary is kept, not the whole result
+        succeeded, result = status
+        self._summary = results.summarize(self._build, succeeded, result,
+                                          self._summary)
+        self._show_notification(self._summary)
 
-    def _show_notification(self, status):
-        if self._notification is None:
+    def _hide_notification(self):
+        if self._notifier is None:
             return
 
-        succeeed, result = status
-        output = '\n'.join([result.stdout.strip(), result.stderr.strip()])
-        output = output
+        self._notifier.hide(unicode(self.working_dir))
 
-        if not succeeed:
-            logging.info('Build #%s failed', self._build)
-            self._notification.update(
-                'Build #%d of %s has failed' % (self._build, self.name),
-                output, 'dialog-error')
-        else:
-            logging.info('Build #%s succeeded', self._build)
-            self._notification.update(
-                'Build #%d of %s was successful' % (self._build, self.name),
-                output, 'dialog-apply')
+    def _show_notification(self, summary):
+        logging.info('Build #%s %s', self._build,
+                     'succeeded' if summary.succeeded else 'failed')
+
+        if self._notifier is None:
+            return
 
-        self._notification.show()
-        self._last_status = status
+        self._notifier.notify(notify.Notification(
+            self.name, self._build, summary.succeeded, summary.describe(),
+            unicode(self.working_dir)))
 
 
 class ProjectBuilder(object):
 
-    def execute_script(self, working_dir, script):
-        return self._execute_script_internal(working_dir, script)
+    def __init__(self):
+        self._warm_runners = {}
+
+    def execute_script(self, working_dir, script, warm_runner=False,
+                       changes=None):
+        """Executes a script in given directory.
+
+        Args:
+            working_dir: a project directory
+            script: a list of commands
+            warm_runner: whether Python commands should be run in a warm
+                interpreter; either a boolean or a list of modules that
+                should be imported before any command is run
+            changes: Changes since the last build; not used locally
+        """
+        return self._execute_script_internal(working_dir, script, warm_runner)
 
     @decorators.with_settings(warn_only=True)
-    def _execute_script_internal(self, working_dir, script):
+    def _execute_script_internal(self, working_dir, script, warm_runner=False):
         succeeded = True
         result = None
 
@@ -309,7 +866,12 @@ class ProjectBuilder(object):
         with context_managers.lcd(working_dir):
             for command in script:
                 logging.info(' %s', command)
-                result = operations.local(command, capture=True)
+                result = None
+                if warm_runner:
+                    result = self._execute_warm(working_dir, command,
+                                                warm_runner)
+                if result is None:
+                    result = operations.local(command, capture=True)
                 succeeded = succeeded and result.succeeded
                 if not succeeded:
                     logging.info('Build failed')
@@ -317,34 +879,226 @@ class ProjectBuilder(object):
 
         return (succeeded, result)
 
+    def _execute_warm(self, working_dir, command, warm_runner):
+        """Runs a command in a warm interpreter.
+
+        Returns:
+            A result similar to the one of operations.local or None when the
+            command has to be run cold.
+        """
+        parsed = warm.parse_command(working_dir, command)
+        if parsed is None:
+            return None
+
+        interpreter, script, argv = parsed
+        imports = warm_runner if isinstance(warm_runner, list) else []
+        key = (working_dir, interpreter)
+
+        runner = self._warm_runners.pop(key, None)
+        if runner is not None:
+            fingerprint = warm.dependency_fingerprint(working_dir, imports)
+            if runner.fingerprint != fingerprint or not runner.is_alive:
+                # Dependencies changed; this run is cold and the next one
+                # will use a fresh zygote.
+                logging.info('Dependencies of %s changed', working_dir)
+                runner.close()
+                return None
+
+        try:
+            runner = runner or warm.WarmRunner(working_dir, interpreter,
+                                               imports)
+            return_code, stdout, stderr = runner.run(script, argv)
+        except (warm.WarmRunnerError, OSError) as e:
+            logging.warning('Warm runner failed, running cold: %s', e)
+            return None
+
+        self._warm_runners[key] = runner
+        return make_result(command, return_code, stdout, stderr)
+
+    def shutdown(self):
+        for runner in self._warm_runners.itervalues():
+            runner.close()
+
+        self._warm_runners.clear()
+
+
+class RemoteBuilder(object):
+    """Runs builds on the least busy worker agent.
+
+    Builds are run by the local builder, one at a time, when there are no
+    workers, or none of them is available. Workers which failed are not used
+    for WORKER_RETRY_DELAY seconds.
+    """
+
+    def __init__(self, local_builder):
+        self._local_builder = local_builder
+        self._local_lock = threading.Lock()
+        self._workers = {}
+        self._in_flight = collections.Counter()
+        self._failed = {}
+        self._lock = threading.Lock()
+
+    @property
+    def workers(self):
+        with self._lock:
+            return sorted(self._workers)
+
+    def register(self, endpoint):
+        logging.info('Registering worker %s', endpoint)
+        with self._lock:
+            if endpoint not in self._workers:
+                self._workers[endpoint] = worker.WorkerClient(endpoint)
+
+    def unregister(self, endpoint):
+        logging.info('Unregistering worker %s', endpoint)
+        with self._lock:
+            self._workers.pop(endpoint, None)
+            self._failed.pop(endpoint, None)
+
+    def capacity(self):
+        """Returns how many builds can run at once: one per worker."""
+        with self._lock:
+            return len(self._workers) or 1
+
+    def _choose_worker(self):
+        """Returns the worker with the fewest builds of this server, or None.
+
+        The chosen worker is counted as busy until _release() is called.
+        """
+        now = time.time()
+        with self._lock:
+            clients = [c for e, c in self._workers.iteritems()
+                       if self._failed.get(e, 0) <= now]
+            if not clients:
+                return None
+
+            # Shuffle, so equally busy workers get builds in turns
+            random.shuffle(clients)
+            client = min(clients, key=lambda c: self._in_flight[c.endpoint])
+            self._in_flight[client.endpoint] += 1
+            return client
+
+    def _release(self, client, failed=False):
+        with self._lock:
+            self._in_flight[client.endpoint] -= 1
+            if failed:
+                self._failed[client.endpoint] = (time.time() +
+                                                 WORKER_RETRY_DELAY)
+
+    def execute_script(self, working_dir, script, warm_runner=False,
+                       changes=None):
+        client = None
+        if changes is not None:
+            client = self._choose_worker()
+
+        if client is not None:
+            failed = True
+            try:
+                status = self._execute_remote(client, working_dir, script,
+                                              changes)
+                failed = False
+                return status
+            except (socket.error, xmlrpclib.Error) as e:
+                logging.error('Build on %s failed; building locally: %s',
+                              client.endpoint, e)
+            finally:
+                self._release(client, failed)
+
+        # Fabric settings are global, so local builds run one at a time
+        with self._local_lock:
+            return self._local_builder.execute_script(
+                working_dir, script, warm_runner, changes)
+
+    def _execute_remote(self, client, working_dir, script, changes):
+        logging.info('Executing a script in %s on %s', working_dir,
+                     client.endpoint)
+
+        # Other workers will get these changes with their next build
+        with self._lock:
+            others = [w for w in self._workers.itervalues() if w is not client]
+        for other in others:
+            other.add_pending(working_dir, changes.paths)
+
+        client.sync(working_dir, changes.paths, changes.list_files,
+                    changes.is_ignored)
+
+        def on_output(chunk):
+            if is_debug_enabled():
+                logging.debug('[%s] %s', client.endpoint, chunk.rstrip())
+
+        return_code, stdout, stderr = client.execute(working_dir, script,
+                                                     on_output)
+        result = make_result(' && '.join(script), return_code, stdout,
+                             stderr)
+        return (result.succeeded, result)
+
+    def shutdown(self):
+        self._local_builder.shutdown()
+
 
 class WatsonServer(object):
 
-    def __init__(self):
+    def __init__(self, config=None, state_file=None):
         logging.info('Starting watson server %s', __version__)
 
-        self._config = Config(load_config_safe(DEFAULT_GLOBAL_CONFIG_FILE))
+        if config is None:
+            config = load_config_safe(DEFAULT_GLOBAL_CONFIG_FILE)
+
+        self._config = Config(config)
+        # Keyed by absolute working directories, as names may repeat
         self._projects = {}
 
-        self._builder = ProjectBuilder()
+        trace.tracer.configure(self._config['trace_sample_rate'],
+                               self._config['trace_buffer_size'])
+
+        self._builder = RemoteBuilder(ProjectBuilder())
+        for endpoint in self._config['workers']:
+            self._builder.register(endpoint)
+
         self._observer = observers.Observer()
         self._scheduler = EventScheduler()
+        self._build_queue = BuildQueue(self._on_build, self._builder.capacity)
+        self._initial_builds = InitialBuilds(
+            self._config['initial_builds'],
+            self._config['initial_build_delay'])
         self._init_pynotify()
+        self._notifier = notify.Notifier(
+            self._create_sinks(), self._config['notification_interval'],
+            self._config['notification_lines'])
+
+        self._state = None
+        self._snapshot_event = None
+        if state_file is not None:
+            self._state = StateStore(state_file)
 
-        # TODO(dejw): read (host, port) from config in user's directory
-        self.endpoint = ('localhost', 0x221B)
+        self.endpoint = parse_endpoint(self._config['endpoint'])
         self._api = SimpleXMLRPCServer.SimpleXMLRPCServer(
             self.endpoint, allow_none=True)
         self._api.register_instance(self)
+        self._serving = False
 
     def _start(self):
-        logging.info('Server listening on %s' % (self.endpoint,))
+        logging.info('Server listening on %s', self.endpoint)
+        restored = self._restore()
         self._scheduler.start()
+        self._build_queue.start()
+        self._notifier.start()
         self._observer.start()
+
+        # Scanning large trees takes a while, so the API is not kept waiting
+        scan = threading.Thread(target=self._rebuild_changed,
+                                args=(restored,), name='RestoreScan')
+        scan.daemon = True
+        scan.start()
+
+        self._serving = True
         self._api.serve_forever()
 
     def _join(self):
-        self._api.shutdown()
+        # shutdown() waits for serve_forever(), so it would hang if _start()
+        # failed before serving
+        if self._serving:
+            self._api.shutdown()
 
     def _init_pynotify(self):
         logging.info('Configuring pynotify')
@@ -355,11 +1109,118 @@ class WatsonServer(object):
         except ImportError:
             logging.error('pynotify not found; notifications disabled')
 
+    def _create_sinks(self):
+        sinks = []
+        for spec in self._config['notification_sinks']:
+            try:
+                sinks.append(notify.create_sink(spec))
+            except ValueError as e:
+                logging.error('Skipping notification sink: %s', e)
+
+        return sinks
+
+    def _restore(self):
+        """Watches projects of the saved state again.
+
+        Returns:
+            A list of (watcher, project state, snapshot time) tuples to check
+            with _rebuild_changed()
+        """
+        if self._state is None:
+            return []
+
+        state = self._state.load()
+        if state is None:
+            return []
+
+        logging.info('Restoring %d projects', len(state['projects']))
+        restored = []
+        for project in state['projects']:
+            working_dir = path.path(project['working_dir'])
+            if not working_dir.isdir():
+                logging.warning('Project %s is gone; forgetting it',
+                                working_dir)
+                continue
+
+            watcher = self._watch_project(working_dir, project['config'])
+            watcher.restore(project)
+            restored.append((watcher, project, state['time']))
+
+        return restored
+
+    def _rebuild_changed(self, restored):
+        """Builds restored projects which have changes not built yet."""
+        for watcher, project, snapshot_time in restored:
+            # Files are compared with the start of the last build, as changes
+            # made during it, or waiting for a build, have not been built yet
+            since = project.get('build_started', snapshot_time) or 0
+            if project.get('pending') or watcher.is_modified_since(since):
+                logging.info('%r has changed since last run', watcher)
+                self._initial_builds.add(watcher)
+
+    def _on_build(self, project):
+        self._initial_builds.done(project)
+        self._schedule_snapshot()
+
+    def _schedule_snapshot(self, *args):
+        if self._state is not None:
+            self._snapshot_event = self._scheduler.schedule(
+                self._snapshot_event, SNAPSHOT_DELAY, self.snapshot)
+
     def hello(self):
         return 'Watson server %s' % __version__
 
+    def status(self, working_dir=None):
+        """Returns statuses of all projects or of the one in a directory."""
+        projects = self._projects.values()
+        if working_dir is not None:
+            project = self._projects.get(path.path(working_dir).abspath())
+            projects = [project] if project is not None else []
+
+        return [p.status() for p in projects]
+
+    def log(self, working_dir):
+        """Returns the output of the last build of a project."""
+        working_dir = path.path(working_dir).abspath()
+        if working_dir not in self._projects:
+            raise WatsonError('%s is not watched' % working_dir)
+
+        return self._projects[working_dir].log.decode('utf-8', 'replace')
+
+    def register_worker(self, endpoint):
+        """Starts sending builds to a worker agent at given endpoint."""
+        self._builder.register(endpoint)
+
+    def unregister_worker(self, endpoint):
+        self._builder.unregister(endpoint)
+
+    def profile(self, seconds=5):
+        """Traces all hot paths for given seconds and returns the dump.
+
+        The dump contains statistics (count, total, mean and max duration)
+        of dispatch, ignore, scheduler_lock and build spans, as well as the
+        most recent spans.
+        """
+        return trace.tracer.profile(min(seconds, MAX_PROFILE_SECONDS))
+
+    def snapshot(self):
+        """Saves the state of all projects, so they survive a restart."""
+        if self._state is None:
+            return
+
+        self._snapshot_event = None
+        try:
+            self._state.save({
+                'time': time.time(),
+                'projects': [p.snapshot() for p in self._projects.values()]})
+        except (IOError, OSError, TypeError, ValueError) as e:
+            # It runs on the scheduler thread, which must keep running
+            logging.error('Could not save state to %s: %s',
+                          self._state.filename, e)
+
     def shutdown(self):
         logging.info('Shuting down')
+        self.snapshot()
 
         for project in self._projects.itervalues():
             project.shutdown()
@@ -367,25 +1228,58 @@ class WatsonServer(object):
         self._api.server_close()
         self._observer.stop()
         self._scheduler.stop()
+        self._build_queue.stop()
+        self._notifier.stop()
 
         self._observer.join()
         self._scheduler.join()
+        self._build_queue.join()
+        self._notifier.join()
+        self._builder.shutdown()
 
         logging.info('Stoppped')
 
     def add_project(self, working_dir, config):
         logging.info('Adding a project: %s', working_dir)
 
-        project_name = get_project_name(working_dir)
-        config = self._config.push(config)
-        logging.debug('%r', config.maps)
-
-        if project_name not in self._projects:
-            self._projects[project_name] = ProjectWatcher(
-                config, working_dir, self._scheduler, self._builder,
-                self._observer)
+        watcher = self._projects.get(path.path(working_dir).abspath())
 
+        if watcher is None:
+            watcher = self._watch_project(working_dir, config)
         else:
-            self._projects[project_name].set_config(config)
+            watcher.update_config(config)
+
+        # Explicitly watched project is the one user works on right now
+        self._build_queue.activate(watcher)
+        watcher.schedule_build(0)
+        self._schedule_snapshot()
+
+    def add_projects(self, projects):
+        """Adds many projects at once; their initial builds are staggered.
+
+        Args:
+            projects: a list of (working_dir, config) pairs
+        """
+        logging.info('Adding %d projects', len(projects))
+
+        for working_dir, config in projects:
+            watcher = self._projects.get(path.path(working_dir).abspath())
+
+            if watcher is None:
+                watcher = self._watch_project(working_dir, config)
+                self._initial_builds.add(watcher)
+            elif watcher.update_config(config) & set(BUILD_CONFIG_KEYS):
+                self._initial_builds.add(watcher)
+
+        self._schedule_snapshot()
+
+    def _watch_project(self, working_dir, config):
+        config = self._config.push(config)
+        logging.debug('%r', config.maps)
 
-        self._projects[project_name].schedule_build(0)
+        working_dir = path.path(working_dir).abspath()
+        watcher = ProjectWatcher(
+            config, working_dir, self._scheduler, self._builder,
+            self._observer, self._build_queue, self._notifier)
+        self._projects[working_dir] = watcher
+        return watcher
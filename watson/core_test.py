@@ -6,12 +6,16 @@ import mox
 import path
 import SimpleXMLRPCServer
 import tempfile
+import threading
+import time
 
 from fabric import context_managers
 from fabric import operations
 from watchdog import observers
 
 from . import core
+from . import notify
+from . import results
 from . import test_helper
 from .test_helper import unittest
 
@@ -31,14 +35,21 @@ class TestFindProjectDirectory(unittest.TestCase):
             _ = core.find_project_directory(tempfile.gettempdir())
 
 
+class TestParseEndpoint(unittest.TestCase):
+
+    def test_host_and_port(self):
+        self.assertEqual(('localhost', 8731),
+                         core.parse_endpoint('localhost:8731'))
+
+    def test_port_only(self):
+        self.assertEqual(('localhost', 8731), core.parse_endpoint(':8731'))
+
+
 class HeadlessProjectWatcher(core.ProjectWatcher):
 
-    def _create_notification(self):
+    def _show_notification(self, summary):
         pass
 
-    def _show_notification(self, status):
-        self._last_status = status
-
     def _hide_notification(self):
         pass
 
@@ -66,7 +77,7 @@ class TestProjectWatcher(test_helper.TestBase):
 
     def get_watcher(self, config=None):
         return HeadlessProjectWatcher(
-            config or {}, self.directory, self.scheduler_mock,
+            core.Config(config or {}), self.directory, self.scheduler_mock,
             self.worker_mock, self.observer_mock)
 
     def test_init(self):
@@ -85,16 +96,19 @@ class TestProjectWatcher(test_helper.TestBase):
         self.mox.VerifyAll()
 
     def test_build(self):
-        status = (True, None)
-        (self.worker_mock.execute_script(self.directory, ['nosetests'])
-            .AndReturn(status))
+        result = core.make_result('nosetests', 1, '', 'FAIL: test_a (t.T)')
+        (self.worker_mock.execute_script(
+            self.directory, ['nosetests'], False, mox.IsA(core.Changes))
+            .AndReturn((False, result)))
         self.mox.ReplayAll()
 
         watcher = self.get_watcher({'name': 'test', 'script': ['nosetests']})
         watcher.build()
 
         self.mox.VerifyAll()
-        self.assertEqual(status, watcher._last_status)
+        self.assertFalse(watcher.succeeded)
+        self.assertEqual(['t.T.test_a'], watcher.status()['new_failures'])
+        self.assertEqual('FAIL: test_a (t.T)', watcher.log)
 
     def test_on_any_event(self):
         Event = collections.namedtuple('Event', ['src_path'])
@@ -109,6 +123,147 @@ class TestProjectWatcher(test_helper.TestBase):
 
         self.mox.VerifyAll()
 
+    def test_on_any_event_skips_directories(self):
+        Event = collections.namedtuple(
+            'Event', ['src_path', 'is_directory', 'dest_path'])
+        self.mox.ReplayAll()
+
+        watcher = self.get_watcher({'ignore': ['.*.pyc']})
+        watcher.schedule_build = lambda: None
+
+        watcher.on_any_event(Event(self.directory, True, None))
+        self.assertIsNone(watcher._changes)
+
+        watcher.on_any_event(Event(self.directory + '/a', True,
+                                   self.directory + '/b'))
+        watcher.on_any_event(Event(self.directory + '/c.py', False,
+                                   self.directory + '/c.pyc'))
+
+        self.mox.VerifyAll()
+        self.assertEqual(set(['a', 'b', 'c.py']), watcher._changes.paths)
+
+    def test_update_config(self):
+        self.mox.ReplayAll()
+
+        watcher = self.get_watcher({'script': ['nosetests'], 'ignore': []})
+        depth = len(watcher._config.maps)
+
+        changed = watcher.update_config({'script': ['nosetests'],
+                                         'ignore': ['.*.pyc']})
+
+        self.mox.VerifyAll()
+        self.assertEqual(set(['ignore']), changed)
+        self.assertEqual(depth, len(watcher._config.maps))
+        self.assertEqual(['.*.pyc'], [i.pattern for i in watcher._ignore])
+
+    def test_watchers_share_ignore_patterns(self):
+        self.observer_mock.schedule(
+            mox.IsA(core.ProjectWatcher), path=self.directory,
+            recursive=True).AndReturn(self.watch)
+        self.mox.ReplayAll()
+
+        first = self.get_watcher({'ignore': ['.*.pyc']})
+        second = self.get_watcher({'ignore': ['.*.pyc']})
+
+        self.mox.VerifyAll()
+        self.assertIs(first._ignore, second._ignore)
+
+    def test_update_config_reschedules_pending_build(self):
+        self.scheduler_mock.schedule(None, 3, mox.IgnoreArg()).AndReturn('e')
+        self.scheduler_mock.schedule('e', 1, mox.IgnoreArg()).AndReturn('f')
+        self.mox.ReplayAll()
+
+        watcher = self.get_watcher({'build_timeout': 3})
+        watcher.schedule_build()
+        watcher.update_config({'build_timeout': 1})
+
+        self.mox.VerifyAll()
+
+    def test_status(self):
+        self.mox.ReplayAll()
+
+        watcher = self.get_watcher()
+        watcher._summary = results.Summary(
+            1, False, [results.Failure('a', ''), results.Failure('b', '')],
+            new_failures=['b'], fixed=['c'])
+
+        self.mox.VerifyAll()
+        self.assertEqual({'name': self.directory,
+                          'working_dir': self.directory,
+                          'build': 0, 'succeeded': False,
+                          'failures': ['a', 'b'], 'failure_count': 2,
+                          'new_failures': ['b'],
+                          'fixed': ['c'], 'scheduled': False},
+                         watcher.status())
+
+    def test_snapshot_and_restore(self):
+        self.mox.ReplayAll()
+
+        watcher = self.get_watcher({'script': ['nosetests']})
+        watcher._build = 3
+        watcher._summary = results.Summary(3, False,
+                                           [results.Failure('a', '')])
+        snapshot = watcher.snapshot()
+
+        watcher._build = 0
+        watcher._summary = None
+        watcher.restore(snapshot)
+
+        self.mox.VerifyAll()
+        self.assertEqual({'script': ['nosetests']}, snapshot['config'])
+        self.assertEqual(3, watcher._build)
+        self.assertFalse(watcher.succeeded)
+        self.assertEqual(['a'], watcher.status()['failures'])
+
+    def test_snapshot_of_pending_build(self):
+        self.scheduler_mock.schedule(None, 3, mox.IgnoreArg()).AndReturn('e')
+        self.mox.ReplayAll()
+
+        watcher = self.get_watcher({'build_timeout': 3})
+        self.assertFalse(watcher.snapshot()['pending'])
+        watcher.schedule_build()
+        watcher._build_started = 100.0
+        snapshot = watcher.snapshot()
+
+        self.mox.VerifyAll()
+        self.assertTrue(snapshot['pending'])
+        self.assertEqual(100.0, snapshot['build_started'])
+
+    def test_is_modified_since(self):
+        self.mox.ReplayAll()
+
+        watcher = self.get_watcher({'ignore': ['.git/.*']})
+        watcher.working_dir = path.path(tempfile.mkdtemp())
+        (watcher.working_dir / '.git').mkdir()
+        (watcher.working_dir / 'file.py').write_text('')
+        try:
+            timestamp = time.time() + 60
+            self.assertFalse(watcher.is_modified_since(timestamp))
+
+            (watcher.working_dir / '.git' / 'index').write_text('')
+            (watcher.working_dir / '.git').utime((timestamp + 1,) * 2)
+            self.assertFalse(watcher.is_modified_since(timestamp))
+
+            (watcher.working_dir / 'file.py').utime((timestamp + 1,) * 2)
+            self.assertTrue(watcher.is_modified_since(timestamp))
+        finally:
+            watcher.working_dir.rmtree()
+
+        self.mox.VerifyAll()
+
+    def test_on_any_event_config_change_without_build_keys(self):
+        Event = collections.namedtuple('Event', ['src_path'])
+        self.mox.ReplayAll()
+
+        watcher = self.get_watcher({'script': ['echo 123'], 'ignore': []})
+        watcher.schedule_build = self.fail
+
+        config_file = path.path(__file__).dirname() / '../fixtures/project1'
+        watcher.working_dir = config_file.abspath()
+        watcher.on_any_event(Event(watcher.working_dir / '.watson.yaml'))
+
+        self.mox.VerifyAll()
+
 
 class HeadlessWatsonServer(core.WatsonServer):
 
@@ -135,10 +290,18 @@ class TestWatsonServer(test_helper.TestBase):
         self.mox.StubOutClassWithMocks(core, "EventScheduler")
         self.scheduler_mock = core.EventScheduler()
 
+        self.mox.StubOutClassWithMocks(core, "BuildQueue")
+        self.build_queue_mock = core.BuildQueue(mox.IgnoreArg(),
+                                                mox.IgnoreArg())
+
+        self.mox.StubOutClassWithMocks(notify, "Notifier")
+        self.notifier_mock = notify.Notifier(
+            mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg())
+
     def test_init(self):
         self.mox.ReplayAll()
 
-        HeadlessWatsonServer()
+        HeadlessWatsonServer({})
 
         self.mox.VerifyAll()
 
@@ -146,12 +309,37 @@ class TestWatsonServer(test_helper.TestBase):
         self.server_mock.serve_forever()
         self.observer_mock.start()
         self.scheduler_mock.start()
+        self.build_queue_mock.start()
+        self.notifier_mock.start()
 
         self.mox.ReplayAll()
 
-        HeadlessWatsonServer()._start()
+        HeadlessWatsonServer({})._start()
+
+        self.mox.VerifyAll()
+
+    def test_start_scans_restored_projects_while_serving(self):
+        serving = threading.Event()
+        self.server_mock.serve_forever().WithSideEffects(serving.set)
+        self.observer_mock.start()
+        self.scheduler_mock.start()
+        self.build_queue_mock.start()
+        self.notifier_mock.start()
+        self.mox.ReplayAll()
+
+        server = HeadlessWatsonServer({})
+        server._restore = lambda: ['restored']
+        scanned = []
+        server._rebuild_changed = lambda restored: scanned.append(
+            serving.wait(10) and restored)
+        server._start()
+
+        deadline = time.time() + 10
+        while not scanned and time.time() < deadline:
+            time.sleep(0.01)
 
         self.mox.VerifyAll()
+        self.assertEqual([['restored']], scanned)
 
     def test_shutdown(self):
         self.server_mock.server_close()
@@ -159,22 +347,307 @@ class TestWatsonServer(test_helper.TestBase):
         self.observer_mock.join()
         self.scheduler_mock.stop()
         self.scheduler_mock.join()
+        self.build_queue_mock.stop()
+        self.build_queue_mock.join()
+        self.notifier_mock.stop()
+        self.notifier_mock.join()
+
+        self.mox.ReplayAll()
+
+        HeadlessWatsonServer({}).shutdown()
+
+        self.mox.VerifyAll()
+
+    def test_profile(self):
+        self.mox.ReplayAll()
+
+        dump = HeadlessWatsonServer({}).profile(0)
+
+        self.mox.VerifyAll()
+        self.assertEqual(1.0, dump['sample_rate'])
+        self.assertIn('stats', dump)
+
+    def test_add_projects_staggers_initial_builds(self):
+        self.mox.ReplayAll()
 
+        server = HeadlessWatsonServer({'initial_builds': 1})
+        watchers = []
+        server._watch_project = lambda d, c: watchers.append(d) or d
+        server._initial_builds = self.mox.CreateMock(core.InitialBuilds)
+        server._initial_builds.add('/a')
+        server._initial_builds.add('/b')
         self.mox.ReplayAll()
 
-        HeadlessWatsonServer().shutdown()
+        server.add_projects([('/a', {}), ('/b', {})])
+
+        self.mox.VerifyAll()
+        self.assertEqual(['/a', '/b'], watchers)
+
+    def test_add_projects_with_the_same_name(self):
+        for directory in ['/a/api', '/b/api']:
+            self.observer_mock.schedule(
+                mox.IsA(core.ProjectWatcher), path=directory,
+                recursive=True).AndReturn(directory)
+        self.mox.ReplayAll()
+
+        server = HeadlessWatsonServer({'initial_builds': 0})
+        server.add_projects([('/a/api', {}), ('/b/api/', {})])
+
+        self.mox.VerifyAll()
+        self.assertEqual(['/a/api', '/b/api'], sorted(server._projects))
+        self.assertEqual([], server.status('/c/api'))
+        self.assertEqual('/b/api', server.status('/b/api')[0]['working_dir'])
+
+    def test_restore_rebuilds_projects_changed_since_their_build(self):
+        self.mox.ReplayAll()
+
+        server = HeadlessWatsonServer({})
+        directory = path.path(__file__).dirname()
+        projects = [
+            {'working_dir': directory, 'config': {}, 'build_started': 50.0},
+            {'working_dir': directory, 'config': {}, 'build_started': 50.0,
+             'pending': True},
+            {'working_dir': directory, 'config': {}, 'build_started': None}]
+        server._state = self.mox.CreateMock(core.StateStore)
+        server._state.load().AndReturn({'time': 100.0, 'projects': projects})
+        server._initial_builds = self.mox.CreateMock(core.InitialBuilds)
+        watchers = []
+        for project, modified in zip(projects, [True, None, True]):
+            watcher = self.mox.CreateMock(core.ProjectWatcher)
+            watcher.restore(project)
+            if modified is not None:
+                since = project['build_started'] or 0
+                watcher.is_modified_since(since).AndReturn(modified)
+            server._initial_builds.add(watcher)
+            watchers.append(watcher)
+        server._watch_project = lambda d, c: watchers.pop(0)
+        self.mox.ReplayAll()
+
+        server._rebuild_changed(server._restore())
+
+        self.mox.VerifyAll()
+
+    def test_snapshot_logs_errors(self):
+        self.mox.ReplayAll()
+
+        server = HeadlessWatsonServer({})
+        server._state = self.mox.CreateMock(core.StateStore)
+        server._state.filename = 'state.json'
+        server._state.save(mox.IsA(dict)).AndRaise(IOError('disk full'))
+        self.mox.ReplayAll()
+
+        server.snapshot()
 
         self.mox.VerifyAll()
 
     def test_hello(self):
         self.mox.ReplayAll()
 
-        version = HeadlessWatsonServer().hello()
+        version = HeadlessWatsonServer({}).hello()
 
         self.mox.VerifyAll()
         self.assertIn(core.__version__, version)
 
 
+class TestStateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = path.path(tempfile.mkdtemp())
+        self.store = core.StateStore(self.directory / 'watson' / 'state')
+
+    def tearDown(self):
+        self.directory.rmtree()
+
+    def test_save_and_load(self):
+        self.store.save({'projects': []})
+
+        self.assertEqual({'projects': []}, self.store.load())
+        self.assertEqual(['state'], [f.name for f in
+                                     self.store.filename.parent.files()])
+
+    def test_load_missing(self):
+        self.assertIsNone(self.store.load())
+
+    def test_load_broken(self):
+        self.store.filename.parent.makedirs_p()
+        self.store.filename.write_text('{"projects": [')
+
+        self.assertIsNone(self.store.load())
+
+
+class TestEventScheduler(unittest.TestCase):
+
+    def test_schedule_replaces_event_which_is_being_run(self):
+        scheduler = core.EventScheduler()
+        event = scheduler.schedule(None, 0, lambda: None)
+
+        # sched pops events from the queue just before running them
+        scheduler._sched.cancel(event)
+
+        scheduler.schedule(event, 0, lambda: None)
+        self.assertEqual(1, len(scheduler._sched.queue))
+
+
+class ProjectMock(object):
+
+    def __init__(self, name, priority=0, last_changed=0, build_due=None):
+        self.name = name
+        self.priority = priority
+        self.last_changed = last_changed
+        self.build_due = build_due
+
+
+class TestBuildQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = core.BuildQueue()
+
+    def pop_built(self):
+        project = self.queue._pop()
+        self.queue._done(project)
+        return project
+
+    def test_rank_by_priority_then_recency(self):
+        old = ProjectMock('old', last_changed=1)
+        new = ProjectMock('new', last_changed=2)
+        important = ProjectMock('important', priority=1)
+
+        for project in [old, new, important]:
+            self.queue.put(project)
+
+        self.assertEqual([important, new, old],
+                         [self.pop_built() for _ in range(3)])
+
+    def test_foreground_goes_first(self):
+        background = ProjectMock('background', priority=10)
+        foreground = ProjectMock('foreground')
+
+        self.queue.put(background)
+        self.queue.put(foreground)
+        self.queue.activate(foreground)
+
+        self.assertIs(foreground, self.queue._pop())
+
+    def test_holds_background_until_foreground_is_built(self):
+        foreground = ProjectMock('foreground', build_due=time.time() + 60)
+        self.queue.put(ProjectMock('background'))
+        self.queue.activate(foreground)
+
+        self.assertIsNotNone(self.queue._hold_timeout())
+
+        self.queue.put(foreground)
+        self.assertIsNone(self.queue._hold_timeout())
+
+    def test_builds_up_to_capacity_at_once(self):
+        queue = core.BuildQueue(capacity=lambda: 2)
+        third = ProjectMock('third')
+        for project in [ProjectMock('first', priority=1),
+                        ProjectMock('second', priority=1), third]:
+            queue.put(project)
+        first = queue._pop()
+        queue._pop()
+
+        popped = []
+        popping = threading.Thread(target=lambda: popped.append(queue._pop()))
+        popping.start()
+        popping.join(0.2)
+        self.assertEqual([], popped)
+
+        queue._done(first)
+        popping.join()
+        self.assertEqual([third], popped)
+
+    def test_project_is_not_built_twice_at_once(self):
+        queue = core.BuildQueue(capacity=lambda: 2)
+        project = ProjectMock('project')
+        queue.put(project)
+        self.assertIs(project, queue._pop())
+
+        queue.put(project)
+        self.assertEqual(set(), queue._pending - queue._building)
+
+        queue._done(project)
+        self.assertIs(project, queue._pop())
+
+    def test_pop_returns_None_when_stopped(self):
+        self.queue.put(ProjectMock('project'))
+        self.queue.stop()
+
+        self.assertIsNone(self.queue._pop())
+
+
+class BuildableProjectMock(ProjectMock):
+
+    def __init__(self, name):
+        super(BuildableProjectMock, self).__init__(name)
+        self.timeouts = []
+
+    def schedule_build(self, timeout=None):
+        self.timeouts.append(timeout)
+
+
+class TestInitialBuilds(unittest.TestCase):
+
+    def setUp(self):
+        self.projects = [BuildableProjectMock('p%d' % i) for i in range(3)]
+
+    def test_limits_builds_in_progress(self):
+        initial_builds = core.InitialBuilds(2, 0)
+        for project in self.projects:
+            initial_builds.add(project)
+
+        self.assertEqual([[0], [0], []], [p.timeouts for p in self.projects])
+
+        initial_builds.done(self.projects[0])
+        self.assertEqual([0], self.projects[2].timeouts)
+
+    def test_staggers_builds(self):
+        initial_builds = core.InitialBuilds(3, 10)
+        for project in self.projects:
+            initial_builds.add(project)
+
+        timeouts = [p.timeouts[0] for p in self.projects]
+        self.assertEqual(0, timeouts[0])
+        self.assertAlmostEqual(10, timeouts[1], places=1)
+        self.assertAlmostEqual(20, timeouts[2], places=1)
+
+    def test_zero_limit_defers_builds(self):
+        initial_builds = core.InitialBuilds(0, 0)
+        initial_builds.add(self.projects[0])
+
+        self.assertEqual([], self.projects[0].timeouts)
+
+    def test_project_built_in_the_meantime_is_skipped(self):
+        initial_builds = core.InitialBuilds(1, 0)
+        initial_builds.add(self.projects[0])
+        initial_builds.add(self.projects[1])
+
+        # The second project changed and has been built
+        initial_builds.done(self.projects[1])
+        initial_builds.done(self.projects[0])
+
+        self.assertEqual([], self.projects[1].timeouts)
+
+
+class TestFindProjects(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = path.path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        self.directory.rmtree()
+
+    def test_find_projects(self):
+        for project in ['a', 'b/c', 'a/nested', '.hidden']:
+            (self.directory / project).makedirs_p()
+            (self.directory / project / '.watson.yaml').write_text('')
+        (self.directory / 'b/not_a_project').makedirs_p()
+
+        self.assertEqual(
+            [self.directory / 'a', self.directory / 'b/c'],
+            [d for d, _ in core.find_projects(self.directory)])
+
+
 class ResultMock(collections.namedtuple('ResultMock', ['succeeded', 'msg'])):
     pass
 
@@ -224,8 +697,39 @@ class TestProjectBuilder(test_helper.TestBase):
         self.assertEqual((False, ResultMock(False, script[1])), result)
 
 
+class TestCompilePatterns(unittest.TestCase):
+
+    def test_patterns_are_shared_while_in_use(self):
+        patterns = core.compile_patterns(['.*.pyc', '.git/.*'])
+
+        self.assertIs(patterns, core.compile_patterns(['.*.pyc', '.git/.*']))
+        self.assertEqual(['.*.pyc', '.git/.*'], [p.pattern for p in patterns])
+
+        del patterns
+        self.assertNotIn(('.*.pyc', '.git/.*'), core._PATTERNS)
+
+
 class TestConfig(unittest.TestCase):
 
+    def test_push_shares_identical_configs(self):
+        config = core.Config({'shards': 1})
+
+        first = config.push({'script': ['nosetests'], 'priority': 1})
+        second = config.push({'priority': 1, 'script': ['nosetests']})
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, config.push({'priority': 2}))
+        self.assertEqual(1, second['priority'])
+
+    def test_replace_returns_shared_config(self):
+        config = core.Config()
+        shared = config.push({'priority': 1})
+
+        replaced = config.push({'priority': 2}).replace({'priority': 1})
+
+        self.assertIs(shared, replaced)
+        self.assertEqual(1, shared['priority'])
+
     def test_default_config(self):
         try:
             core.Config()['ignore']
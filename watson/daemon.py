@@ -5,8 +5,15 @@ from __future__ import absolute_import
 import logging
 import os
 import path
+import signal
+import SimpleXMLRPCServer
+import socket
+import subprocess
 import sys
+import threading
 import time
+import xmlrpclib
+import zlib
 
 from daemon import runner
 
@@ -15,6 +22,284 @@ from . import core
 
 WATSON_DIR = path.path('~/.watson').expand()
 
+# How often crashed shards are looked for
+MONITOR_INTERVAL = 1
+
+# Restart delays of shards that keep crashing
+MIN_RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+
+
+def shard_index(working_dir, shards):
+    """Returns the index of the shard that owns given project."""
+    working_dir = path.path(working_dir).abspath()
+    return (zlib.crc32(working_dir.encode('utf-8')) & 0xffffffff) % shards
+
+
+class Shard(object):
+    """A server process which watches a part of all projects."""
+
+    def __init__(self, index, endpoint):
+        self.index = index
+        self.endpoint = endpoint
+        self.restart_delay = MIN_RESTART_DELAY
+        self.next_start = 0
+
+        self._process = None
+        self._started = None
+
+    def __repr__(self):
+        return '<Shard %d(%s)>' % (self.index, self.endpoint)
+
+    @property
+    def is_alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self, timeout=10):
+        logging.info('Starting %r', self)
+        self._started = time.time()
+        # Daemon runs in /, so make sure this very watson is imported
+        python_path = [os.path.dirname(os.path.dirname(core.__file__))]
+        python_path += filter(None, [os.environ.get('PYTHONPATH')])
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(python_path))
+
+        self._process = subprocess.Popen(
+            [sys.executable, '-m', 'watson.daemon', 'shard', str(self.index),
+             self.endpoint], env=env)
+
+        deadline = time.time() + timeout
+        while time.time() < deadline and self.is_alive:
+            try:
+                self.call('hello')
+                return
+            except socket.error:
+                time.sleep(0.1)
+
+        raise core.WatsonError('%r did not start' % self)
+
+    def crashed(self):
+        """Schedules a restart, backing off when the shard keeps crashing."""
+        if time.time() - self._started < MAX_RESTART_DELAY:
+            self.restart_delay = min(self.restart_delay * 2,
+                                     MAX_RESTART_DELAY)
+        else:
+            self.restart_delay = MIN_RESTART_DELAY
+
+        self.next_start = time.time() + self.restart_delay
+
+    def call(self, method, *args):
+        # ServerProxy is not thread-safe, so each call gets its own
+        proxy = xmlrpclib.ServerProxy('http://%s/' % self.endpoint,
+                                      allow_none=True)
+        return getattr(proxy, method)(*args)
+
+    def stop(self, timeout=10):
+        if not self.is_alive:
+            return
+
+        logging.info('Stopping %r', self)
+        self._process.terminate()
+
+        deadline = time.time() + timeout
+        while time.time() < deadline and self.is_alive:
+            time.sleep(0.1)
+
+        if self.is_alive:
+            self._process.kill()
+        self._process.wait()
+
+
+class Supervisor(object):
+    """Spreads projects across several server processes (shards).
+
+    Projects are assigned to shards by a hash of their path and the API calls
+    are routed to the right shard. Shards listen on consecutive ports after
+    the supervisor's one, and are restarted when they crash.
+    """
+
+    def __init__(self, config):
+        self._config = core.Config(config)
+        self._projects = {}
+        self._workers = set()
+        self._lock = threading.Lock()
+        self._is_finished = threading.Event()
+
+        self.endpoint = core.parse_endpoint(self._config['endpoint'])
+        host, port = self.endpoint
+        self._shards = [Shard(i, '%s:%d' % (host, port + 1 + i))
+                        for i in range(self._config['shards'])]
+
+        self._monitor = threading.Thread(target=self._monitor_shards)
+        self._api = SimpleXMLRPCServer.SimpleXMLRPCServer(
+            self.endpoint, allow_none=True)
+        self._api.register_instance(self)
+        self._serving = False
+
+    def _start(self):
+        logging.info('Supervisor listening on %s', self.endpoint)
+        for shard in self._shards:
+            shard.start()
+
+        self._monitor.start()
+        self._serving = True
+        self._api.serve_forever()
+
+    def _join(self):
+        # See core.WatsonServer._join
+        if self._serving:
+            self._api.shutdown()
+
+    def _shard_for(self, working_dir):
+        return self._shards[shard_index(working_dir, len(self._shards))]
+
+    def _monitor_shards(self):
+        while not self._is_finished.wait(MONITOR_INTERVAL):
+            for shard in self._shards:
+                if shard.is_alive or self._is_finished.is_set():
+                    continue
+
+                if not shard.next_start:
+                    logging.error('%r has crashed', shard)
+                    shard.crashed()
+
+                if time.time() >= shard.next_start:
+                    try:
+                        self._restart(shard)
+                    except Exception:
+                        # Keep monitoring the other shards
+                        logging.exception('Restart of %r failed', shard)
+
+    def _restart(self, shard):
+        try:
+            shard.start()
+            shard.next_start = 0
+        except core.WatsonError as e:
+            logging.error('%s; retrying in %ss', e, shard.restart_delay)
+            shard.stop()
+            shard.crashed()
+            return
+
+        # Shards restore their projects from snapshots; add the rest
+        with self._lock:
+            projects = [(d, c) for d, c in self._projects.iteritems()
+                        if self._shard_for(d) is shard]
+            workers = list(self._workers)
+
+        for endpoint in workers:
+            self._call_logged(shard, 'register_worker', endpoint)
+
+        statuses = self._call_logged(shard, 'status')
+        if statuses is None:
+            return
+
+        known = set(s['working_dir'] for s in statuses)
+        for working_dir, config in projects:
+            if working_dir in known:
+                continue
+
+            if not path.path(working_dir).isdir():
+                logging.warning('Project %s is gone; forgetting it',
+                                working_dir)
+                with self._lock:
+                    self._projects.pop(working_dir, None)
+                continue
+
+            self._call_logged(shard, 'add_project', working_dir, config)
+
+    def _call_logged(self, shard, method, *args):
+        """Calls a shard; returns None and logs the error if it fails."""
+        try:
+            return shard.call(method, *args)
+        except (socket.error, xmlrpclib.Error) as e:
+            logging.error('Calling %s on %r failed: %s', method, shard, e)
+
+    def hello(self):
+        return 'Watson supervisor %s (%d shards)' % (
+            core.__version__, len(self._shards))
+
+    def add_project(self, working_dir, config):
+        with self._lock:
+            self._projects[working_dir] = config
+
+        return self._shard_for(working_dir).call(
+            'add_project', working_dir, config)
+
+    def add_projects(self, projects):
+        shards = {}
+        with self._lock:
+            for working_dir, config in projects:
+                self._projects[working_dir] = config
+                shard = self._shard_for(working_dir)
+                shards.setdefault(shard, []).append((working_dir, config))
+
+        for shard, shard_projects in shards.iteritems():
+            shard.call('add_projects', shard_projects)
+
+    def register_worker(self, endpoint):
+        with self._lock:
+            self._workers.add(endpoint)
+        self._broadcast('register_worker', endpoint)
+
+    def unregister_worker(self, endpoint):
+        with self._lock:
+            self._workers.discard(endpoint)
+        self._broadcast('unregister_worker', endpoint)
+
+    def _broadcast(self, method, *args):
+        for shard in self._shards:
+            try:
+                shard.call(method, *args)
+            except socket.error:
+                logging.warning('%r is not available', shard)
+
+    def status(self, working_dir=None):
+        if working_dir is not None:
+            return self._shard_for(working_dir).call('status', working_dir)
+
+        statuses = []
+        for shard in self._shards:
+            try:
+                statuses.extend(shard.call('status'))
+            except socket.error:
+                logging.warning('%r is not available', shard)
+
+        return statuses
+
+    def log(self, working_dir):
+        return self._shard_for(working_dir).call('log', working_dir)
+
+    def profile(self, seconds=5):
+        """Profiles all shards at once; returns their dumps by endpoints."""
+        dumps = {}
+
+        def profile_shard(shard):
+            try:
+                dumps[shard.endpoint] = shard.call('profile', seconds)
+            except socket.error:
+                logging.warning('%r is not available', shard)
+
+        threads = [threading.Thread(target=profile_shard, args=(shard,))
+                   for shard in self._shards]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return dumps
+
+    def shutdown(self):
+        logging.info('Shuting down')
+        self._is_finished.set()
+        self._api.server_close()
+
+        if self._monitor.is_alive():
+            self._monitor.join()
+
+        for shard in self._shards:
+            shard.stop()
+
+        logging.info('Stoppped')
+
 
 class _DaemonRunner(runner.DaemonRunner):
     """Modified DaemonRunner that checks pidfile before opening a context."""
@@ -52,14 +337,38 @@ class WatsonDaemon(object):
         # Create watson directory if it is not already there
         WATSON_DIR.mkdir_p()
 
-    def run(self):
-        logging.basicConfig(level=logging.DEBUG,
+    def _load_config(self):
+        config = core.Config(
+            core.load_config_safe(core.DEFAULT_GLOBAL_CONFIG_FILE))
+
+        logging.basicConfig(level=config['log_level'].upper(),
                             format='%(levelname)-8s %(asctime)s '
                             '%(filename)s:%(lineno)s] %(message)s')
+        return config
+
+    def run(self):
+        config = self._load_config()
+
+        if config['shards'] > 1:
+            self._serve(lambda: Supervisor(config.maps[0]))
+        else:
+            self._serve(lambda: core.WatsonServer(
+                config.maps[0], state_file=WATSON_DIR / 'state.json'))
 
+    def run_shard(self, index, endpoint):
+        """Runs a server as one of the supervisor's shards."""
+        config = dict(self._load_config().maps[0], endpoint=endpoint)
+
+        # Supervisor stops shards with SIGTERM
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+        self._serve(lambda: core.WatsonServer(
+            config, state_file=WATSON_DIR / ('state-%d.json' % index)))
+
+    def _serve(self, server_factory):
         server = None
         try:
-            server = core.WatsonServer()
+            server = server_factory()
             server._start()
         except KeyboardInterrupt:
             pass
@@ -84,5 +393,8 @@ def main():
     if command in ['run']:
         WatsonDaemon().run()
 
+    if command == 'shard':
+        WatsonDaemon().run_shard(int(sys.argv[2]), sys.argv[3])
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import mox
+import path
+import SimpleXMLRPCServer
+import socket
+import threading
+import time
+import xmlrpclib
+
+from . import core
+from . import daemon
+from . import test_helper
+from .test_helper import unittest
+
+
+class TestShardIndex(unittest.TestCase):
+
+    def test_stable(self):
+        self.assertEqual(daemon.shard_index('/home/user/project', 8),
+                         daemon.shard_index('/home/user/project/', 8))
+
+    def test_spread(self):
+        indexes = set(daemon.shard_index('/home/user/project%d' % i, 4)
+                      for i in range(100))
+
+        self.assertEqual(set(range(4)), indexes)
+
+
+class AliveProcessMock(object):
+
+    def poll(self):
+        return None
+
+
+class TestSupervisor(test_helper.TestBase):
+
+    def setUp(self):
+        super(TestSupervisor, self).setUp()
+
+        self.mox.StubOutClassWithMocks(SimpleXMLRPCServer,
+                                       "SimpleXMLRPCServer")
+        self.server_mock = SimpleXMLRPCServer.SimpleXMLRPCServer(
+            ('localhost', 0x221B), allow_none=True)
+        self.server_mock.register_instance(mox.IsA(daemon.Supervisor))
+
+    def get_supervisor(self):
+        supervisor = daemon.Supervisor({'shards': 2})
+        for shard in supervisor._shards:
+            shard.call = self.mox.CreateMockAnything()
+
+        return supervisor
+
+    def test_shard_endpoints(self):
+        self.mox.ReplayAll()
+
+        supervisor = self.get_supervisor()
+
+        self.mox.VerifyAll()
+        self.assertEqual(['localhost:8732', 'localhost:8733'],
+                         [s.endpoint for s in supervisor._shards])
+
+    def test_add_project(self):
+        self.mox.ReplayAll()
+        supervisor = self.get_supervisor()
+        shard = supervisor._shard_for('/project')
+        self.mox.ResetAll()
+
+        shard.call('add_project', '/project', {'script': []})
+        self.mox.ReplayAll()
+
+        supervisor.add_project('/project', {'script': []})
+
+        self.mox.VerifyAll()
+
+    def test_add_projects_in_one_call_per_shard(self):
+        self.mox.ReplayAll()
+        supervisor = self.get_supervisor()
+        projects = [('/project%d' % i, {}) for i in range(10)]
+        self.mox.ResetAll()
+
+        for shard in supervisor._shards:
+            shard.call('add_projects', [
+                p for p in projects if supervisor._shard_for(p[0]) is shard])
+        self.mox.ReplayAll()
+
+        supervisor.add_projects(projects)
+
+        self.mox.VerifyAll()
+        self.assertEqual(10, len(supervisor._projects))
+
+    def test_log(self):
+        self.mox.ReplayAll()
+        supervisor = self.get_supervisor()
+        shard = supervisor._shard_for('/project')
+        self.mox.ResetAll()
+
+        shard.call('log', '/project').AndReturn('output')
+        self.mox.ReplayAll()
+
+        self.assertEqual('output', supervisor.log('/project'))
+
+        self.mox.VerifyAll()
+
+    def test_profile_all_shards(self):
+        self.mox.ReplayAll()
+        supervisor = self.get_supervisor()
+        self.mox.ResetAll()
+
+        supervisor._shards[0].call('profile', 3).AndReturn({'stats': 0})
+        supervisor._shards[1].call('profile', 3).AndRaise(socket.error())
+        self.mox.ReplayAll()
+
+        self.assertEqual({'localhost:8732': {'stats': 0}},
+                         supervisor.profile(3))
+
+        self.mox.VerifyAll()
+
+    def test_restart_adds_missing_projects(self):
+        self.mox.ReplayAll()
+        supervisor = self.get_supervisor()
+        project = path.path(__file__).dirname()
+        shard = supervisor._shard_for(project)
+        supervisor._projects = {project: {}, '/restored': {}}
+        self.mox.ResetAll()
+
+        shard.start = lambda: None
+        shard.call('status').AndReturn([{'working_dir': '/restored'}])
+        shard.call('add_project', project, {})
+        self.mox.ReplayAll()
+
+        supervisor._shard_for = lambda working_dir: shard
+        supervisor._restart(shard)
+
+        self.mox.VerifyAll()
+
+    def test_monitor_survives_failing_restart(self):
+        self.mox.ReplayAll()
+        supervisor = daemon.Supervisor({'shards': 1})
+        shard = supervisor._shards[0]
+        self.mox.stubs.Set(daemon, 'MONITOR_INTERVAL', 0.01)
+        shard._started = 0
+
+        broken = path.path(__file__).dirname()
+        added = broken.parent
+        supervisor._projects = {broken: {}, added: {},
+                                '/nonexistent/watson-project': {}}
+        supervisor._workers = set(['buildbox1:8987'])
+
+        calls = []
+        restarted = threading.Event()
+
+        def start():
+            shard._process = AliveProcessMock()
+            shard._started = time.time()
+
+        def call(method, *args):
+            calls.append((method,) + args)
+            if method == 'register_worker':
+                raise socket.error('Connection refused')
+            elif method == 'status':
+                return []
+            elif args[0] == broken:
+                raise xmlrpclib.Fault(1, "<type 'exceptions.OSError'>")
+            restarted.set()
+
+        shard.start, shard.call = start, call
+        supervisor._monitor.start()
+        try:
+            self.assertTrue(restarted.wait(10))
+        finally:
+            supervisor._is_finished.set()
+            supervisor._monitor.join()
+
+        self.mox.VerifyAll()
+        self.assertEqual(
+            sorted([('register_worker', 'buildbox1:8987'), ('status',),
+                    ('add_project', broken, {}), ('add_project', added, {})]),
+            sorted(calls))
+        self.assertEqual(set([broken, added]), set(supervisor._projects))
+
+    def test_failed_start_does_not_hang(self):
+        self.server_mock.server_close()
+        self.mox.ReplayAll()
+        supervisor = self.get_supervisor()
+
+        def fail():
+            raise core.WatsonError('Shard did not start')
+
+        supervisor._shards[0].start = fail
+        supervisor._shards[0].stop = supervisor._shards[1].stop = lambda: None
+
+        self.assertRaises(core.WatsonError, supervisor._start)
+        supervisor.shutdown()
+        supervisor._join()
+
+        self.mox.VerifyAll()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+"""Build notifications dispatched in background to configurable sinks."""
+
+from __future__ import absolute_import
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+import urllib2
+
+
+# Desktop notifications kept for updating in place; others are closed
+MAX_DESKTOP_NOTIFICATIONS = 20
+
+
+class Notification(object):
+    """A build status of a project.
+
+    Notifications are told apart by the project's working directory, as
+    projects in different directories may have the same name.
+    """
+
+    __slots__ = ['project', 'working_dir', 'build', 'succeeded', 'output',
+                 'time']
+
+    def __init__(self, project, build, succeeded, output, working_dir=None):
+        self.project = project
+        self.working_dir = working_dir or project
+        self.build = build
+        self.succeeded = succeeded
+        self.output = output
+        self.time = time.time()
+
+    def __repr__(self):
+        return '<Notification %s#%s>' % (self.project, self.build)
+
+    @property
+    def title(self):
+        status = 'was successful' if self.succeeded else 'has failed'
+        return 'Build #%d of %s %s' % (self.build, self.project, status)
+
+    @property
+    def icon(self):
+        return 'dialog-apply' if self.succeeded else 'dialog-error'
+
+    def as_dict(self):
+        return {'project': self.project, 'working_dir': self.working_dir,
+                'build': self.build,
+                'succeeded': self.succeeded, 'title': self.title,
+                'output': self.output, 'time': self.time}
+
+
+def truncate(output, lines):
+    """Returns only the last lines of the output."""
+    output = output.splitlines()
+    if len(output) <= lines:
+        return '\n'.join(output)
+
+    skipped = len(output) - lines
+    return '\n'.join(['(%d lines skipped)' % skipped] + output[-lines:])
+
+
+class DesktopSink(object):
+    """Shows notifications on the desktop using pynotify.
+
+    Notifications are created when a project is built for the first time and
+    only those of the most recently built projects are kept.
+    """
+
+    def __init__(self, timeout=3):
+        self._timeout = timeout
+        self._notifications = collections.OrderedDict()
+        self._disabled = False
+
+    def _get_notification(self, project):
+        notification = self._notifications.pop(project, None)
+        if notification is None:
+            import pynotify
+            notification = pynotify.Notification('')
+            notification.set_timeout(self._timeout)
+
+        self._notifications[project] = notification
+        while len(self._notifications) > MAX_DESKTOP_NOTIFICATIONS:
+            self._notifications.popitem(last=False)[1].close()
+
+        return notification
+
+    def send(self, notification):
+        if self._disabled:
+            return
+
+        try:
+            desktop = self._get_notification(notification.working_dir)
+        except ImportError:
+            logging.error('pynotify not found; desktop notifications disabled')
+            self._disabled = True
+            return
+
+        desktop.update(notification.title, notification.output,
+                       notification.icon)
+        desktop.show()
+
+    def hide(self, project):
+        desktop = self._notifications.pop(project, None)
+        if desktop is not None:
+            desktop.close()
+
+
+class FileSink(object):
+    """Appends notifications to a file as JSON lines."""
+
+    def __init__(self, filename):
+        self.filename = os.path.expanduser(filename)
+
+    def send(self, notification):
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(notification.as_dict()) + '\n')
+
+    def hide(self, project):
+        pass
+
+
+class WebhookSink(object):
+    """POSTs notifications as JSON to an HTTP endpoint."""
+
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self._timeout = timeout
+
+    def send(self, notification):
+        request = urllib2.Request(
+            self.url, json.dumps(notification.as_dict()),
+            {'Content-Type': 'application/json'})
+        urllib2.urlopen(request, timeout=self._timeout).close()
+
+    def hide(self, project):
+        pass
+
+
+SINKS = {
+    'desktop': DesktopSink,
+    'file': FileSink,
+    'webhook': WebhookSink,
+}
+
+
+def create_sink(spec):
+    """Creates a sink from its config, e.g. 'desktop' or {'file': path}.
+
+    Raises:
+        ValueError: when the sink is unknown
+    """
+    if isinstance(spec, basestring):
+        name, args = spec, []
+    elif isinstance(spec, dict) and len(spec) == 1:
+        name, arg = spec.items()[0]
+        args = [arg]
+    else:
+        raise ValueError('invalid notification sink: %r' % (spec,))
+
+    if name not in SINKS:
+        raise ValueError('unknown notification sink: %r' % (name,))
+
+    return SINKS[name](*args)
+
+
+class Dispatcher(threading.Thread):
+    """Sends notifications to a single sink.
+
+    Notifications of a project are sent at most once per interval; the ones
+    that arrive in the meantime are collapsed, so only the latest is sent.
+    """
+
+    def __init__(self, sink, interval):
+        threading.Thread.__init__(self, name='%s' % type(sink).__name__)
+        self.daemon = True
+
+        self._sink = sink
+        self._interval = interval
+        self._pending = collections.OrderedDict()
+        self._last_sent = {}
+        self._is_finished = False
+        self._condition = threading.Condition()
+
+    def put(self, project, notification):
+        """Queues a notification; None hides the project's notification."""
+        with self._condition:
+            self._pending[project] = notification
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._is_finished = True
+            self._condition.notify()
+
+    def _pop(self):
+        with self._condition:
+            while not self._is_finished:
+                now = time.time()
+                timeout = None
+                for project, notification in self._pending.iteritems():
+                    due = self._last_sent.get(project, 0) + self._interval
+                    if notification is None or due <= now:
+                        del self._pending[project]
+                        self._last_sent[project] = now
+                        return project, notification
+
+                    if timeout is None or due - now < timeout:
+                        timeout = due - now
+
+                self._condition.wait(timeout)
+
+            return None, None
+
+    def run(self):
+        while True:
+            project, notification = self._pop()
+            if project is None:
+                break
+
+            try:
+                if notification is None:
+                    self._sink.hide(project)
+                else:
+                    self._sink.send(notification)
+            except Exception:
+                logging.exception('%s failed to handle %s', self.name,
+                                  notification or project)
+
+
+class Notifier(object):
+    """Dispatches notifications to all sinks in background threads."""
+
+    def __init__(self, sinks, interval=2, lines=20):
+        self.lines = lines
+        self._dispatchers = [Dispatcher(sink, interval) for sink in sinks]
+
+    def start(self):
+        for dispatcher in self._dispatchers:
+            dispatcher.start()
+
+    def notify(self, notification):
+        notification.output = truncate(notification.output, self.lines)
+        for dispatcher in self._dispatchers:
+            dispatcher.put(notification.working_dir, notification)
+
+    def hide(self, working_dir):
+        for dispatcher in self._dispatchers:
+            dispatcher.put(working_dir, None)
+
+    def stop(self):
+        for dispatcher in self._dispatchers:
+            dispatcher.stop()
+
+    def join(self, timeout=None):
+        for dispatcher in self._dispatchers:
+            if dispatcher.is_alive():
+                dispatcher.join(timeout)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import json
+import shutil
+import tempfile
+import time
+
+from . import notify
+from .test_helper import unittest
+
+
+class SinkMock(object):
+
+    def __init__(self):
+        self.sent = []
+        self.hidden = []
+
+    def send(self, notification):
+        self.sent.append(notification)
+
+    def hide(self, project):
+        self.hidden.append(project)
+
+
+class TestTruncate(unittest.TestCase):
+
+    def test_short_output(self):
+        self.assertEqual('a\nb', notify.truncate('a\nb\n', 2))
+
+    def test_keeps_last_lines(self):
+        self.assertEqual('(2 lines skipped)\nc\nd',
+                         notify.truncate('a\nb\nc\nd', 2))
+
+
+class TestCreateSink(unittest.TestCase):
+
+    def test_desktop(self):
+        self.assertIsInstance(notify.create_sink('desktop'),
+                              notify.DesktopSink)
+
+    def test_webhook(self):
+        sink = notify.create_sink({'webhook': 'http://localhost:8000/'})
+
+        self.assertIsInstance(sink, notify.WebhookSink)
+        self.assertEqual('http://localhost:8000/', sink.url)
+
+    def test_ValueError_unknown_sink(self):
+        with self.assertRaises(ValueError):
+            notify.create_sink('carrier-pigeon')
+
+
+class TestFileSink(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_send(self):
+        sink = notify.FileSink(self.directory + '/notifications')
+
+        sink.send(notify.Notification('project', 1, True, 'OK'))
+        sink.send(notify.Notification('project', 2, False, 'FAIL'))
+
+        with open(sink.filename) as f:
+            lines = [json.loads(line) for line in f]
+
+        self.assertEqual([1, 2], [line['build'] for line in lines])
+        self.assertEqual('Build #2 of project has failed', lines[1]['title'])
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def test_collapses_notifications_of_a_project(self):
+        sink = SinkMock()
+        dispatcher = notify.Dispatcher(sink, 60)
+        first, second, third = [notify.Notification('project', i, True, '')
+                                for i in range(3)]
+
+        dispatcher.put('project', first)
+        self.assertEqual(('project', first), dispatcher._pop())
+
+        dispatcher.put('project', second)
+        dispatcher.put('project', third)
+        self.assertEqual([third], dispatcher._pending.values())
+
+    def test_hide_is_not_rate_limited(self):
+        dispatcher = notify.Dispatcher(SinkMock(), 60)
+        dispatcher.put('project', notify.Notification('project', 1, True, ''))
+        dispatcher._pop()
+
+        dispatcher.put('project', None)
+
+        self.assertEqual(('project', None), dispatcher._pop())
+
+    def test_projects_with_the_same_name_are_not_collapsed(self):
+        notifier = notify.Notifier([SinkMock()], interval=60)
+        dispatcher = notifier._dispatchers[0]
+        first, second = [notify.Notification('api', 1, True, '', directory)
+                         for directory in ['/a/api', '/b/api']]
+
+        notifier.notify(first)
+        notifier.notify(second)
+        notifier.hide('/a/api')
+
+        self.assertEqual([('/a/api', None), ('/b/api', second)],
+                         dispatcher._pending.items())
+
+    def test_slow_sink_does_not_block_notify(self):
+        class SlowSink(SinkMock):
+            def send(self, notification):
+                time.sleep(0.5)
+
+        notifier = notify.Notifier([SlowSink()], interval=0)
+        notifier.start()
+
+        start = time.time()
+        for build in range(10):
+            notifier.notify(notify.Notification('project', build, True, ''))
+        notifier.stop()
+
+        self.assertLess(time.time() - start, 0.5)
+        notifier.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""Compact build results: failures parsed from the output and a diff of them
+against the previous build.
+
+Recognized are failures reported by unittest and nose, pytest and pep8-like
+checkers (pep8, pycodestyle, flake8). The complete output is kept only
+compressed, and summaries are bounded, as servers keep one per project.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import re
+import zlib
+
+
+# Bounds of a summary; failures over the limit are only counted
+MAX_FAILURES = 100
+MAX_MESSAGE_LENGTH = 200
+MAX_LOG_SIZE = 256 * 1024
+
+Failure = collections.namedtuple('Failure', ['name', 'message'])
+
+# FAIL: test_build (watson.core_test.TestProjectWatcher)
+_UNITTEST_RE = re.compile(r'^(?:FAIL|ERROR): (\w+) \(([\w.]+)\)')
+
+# FAILED watson/core_test.py::test_build - AssertionError: ...
+_PYTEST_SUMMARY_RE = re.compile(
+    r'^(?:FAILED|ERROR) (\S+\.py(?:::\S+)?)(?: - (.*))?$')
+
+# watson/core_test.py::test_build FAILED [ 50%]
+_PYTEST_VERBOSE_RE = re.compile(r'^(\S+\.py::\S+) (?:FAILED|ERROR)\b')
+
+# watson/core.py:12:80: E501 line too long (82 > 79 characters)
+_PEP8_RE = re.compile(r'^(\S+?):(\d+):(\d+): ([A-Z]+\d+) (.*)$')
+
+
+def _parse_unittest(lines, index, match):
+    test, case = match.groups()
+    name = case if case.endswith('.' + test) else '%s.%s' % (case, test)
+
+    # The exception follows the (indented) traceback
+    message = ''
+    in_traceback = False
+    for line in lines[index + 1:]:
+        if line.startswith('='):
+            break
+        if line.startswith('Traceback'):
+            in_traceback = True
+        elif in_traceback and line.strip() and not line[0].isspace():
+            message = line.strip()
+            break
+
+    return Failure(name, message)
+
+
+def parse_failures(output):
+    """Returns a list of failures found in a build output."""
+    failures = collections.OrderedDict()
+    occurrences = collections.Counter()
+    lines = output.splitlines()
+
+    for index, line in enumerate(lines):
+        match = _UNITTEST_RE.match(line)
+        if match:
+            failure = _parse_unittest(lines, index, match)
+        elif _PYTEST_SUMMARY_RE.match(line):
+            name, message = _PYTEST_SUMMARY_RE.match(line).groups()
+            failure = Failure(name, message or '')
+        elif _PYTEST_VERBOSE_RE.match(line):
+            failure = Failure(_PYTEST_VERBOSE_RE.match(line).group(1), '')
+        elif _PEP8_RE.match(line):
+            # Lines (and texts, which may contain them) are left out of the
+            # name, so violations do not look new just because code above
+            # them has changed; repeated ones are told apart by their order
+            filename, row, column, code, text = _PEP8_RE.match(line).groups()
+            occurrences[filename, code] += 1
+            failure = Failure(
+                '%s: %s #%d' % (filename, code, occurrences[filename, code]),
+                'line %s: %s' % (row, text))
+        else:
+            continue
+
+        # Keep the most detailed message of a repeatedly reported failure
+        if failure.message or failure.name not in failures:
+            failures[failure.name] = failure
+
+    return failures.values()
+
+
+def _compress(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return zlib.compress(text) if text else ''
+
+
+def _decompress(data):
+    return zlib.decompress(data) if data else ''
+
+
+class Summary(object):
+    """A result of a build: its status, failures and compressed output.
+
+    At most MAX_FAILURES failures (as well as newly failing and fixed ones)
+    are kept, so failures over the limit are not diffed, and only the last
+    MAX_LOG_SIZE bytes of the output. Failures are kept compressed, and their
+    messages only for the new ones.
+    """
+
+    __slots__ = ['build', 'succeeded', 'failure_count', 'new_failures',
+                 'fixed', '_failures', '_messages', '_log']
+
+    def __init__(self, build, succeeded, failures=(), new_failures=(),
+                 fixed=(), log=''):
+        """Creates a summary.
+
+        Args:
+            build: a build number
+            succeeded: whether the build has succeeded
+            failures: a list of all Failures
+            new_failures: a list of names of newly failing ones
+            fixed: a list of names of fixed ones
+            log: an output of the build
+        """
+        self.build = build
+        self.succeeded = succeeded
+        self.failure_count = len(failures)
+        self.fixed = tuple(fixed[:MAX_FAILURES])
+
+        failures = failures[:MAX_FAILURES]
+        self._failures = _compress('\n'.join(f.name for f in failures))
+
+        new = set(new_failures)
+        self.new_failures = tuple(f.name for f in failures if f.name in new)
+        self._messages = _compress('\n'.join(
+            f.message[:MAX_MESSAGE_LENGTH].replace('\n', ' ')
+            for f in failures if f.name in new))
+
+        if isinstance(log, unicode):
+            log = log.encode('utf-8')
+        self._log = _compress(log[-MAX_LOG_SIZE:])
+
+    def __repr__(self):
+        return '<Summary #%s %s>' % (
+            self.build, 'succeeded' if self.succeeded else 'failed')
+
+    @property
+    def log(self):
+        """The output of the build (its last MAX_LOG_SIZE bytes)."""
+        return _decompress(self._log)
+
+    @property
+    def failures(self):
+        """Names of failures (at most MAX_FAILURES of them)."""
+        names = _decompress(self._failures)
+        return names.split('\n') if names else []
+
+    def describe(self):
+        """Returns a text for notifications; the most important goes last."""
+        if not self.failure_count and not self.fixed:
+            return self.log
+
+        new = set(self.new_failures)
+        messages = _decompress(self._messages).split('\n')
+        lines = ['failing: %s' % name
+                 for name in self.failures if name not in new]
+        lines.extend('fixed: %s' % name for name in self.fixed)
+        lines.extend(('new: %s %s' % failure).strip()
+                     for failure in zip(self.new_failures, messages))
+        lines.append('%d failing, %d new, %d fixed' % (
+            self.failure_count, len(self.new_failures), len(self.fixed)))
+        return '\n'.join(lines)
+
+
+def summarize(build, succeeded, result, previous=None):
+    """Summarizes a build result, comparing it with the previous summary.
+
+    Args:
+        build: a build number
+        succeeded: whether the build has succeeded
+        result: a result of the last command (with stdout and stderr), or None
+        previous: a Summary of the previous build, or None
+
+    Returns:
+        A Summary
+    """
+    log = ''
+    if result is not None:
+        log = '\n'.join([result.stdout.strip(), result.stderr.strip()])
+
+    failures = parse_failures(log)
+    names = set(f.name for f in failures)
+    known = set()
+    if previous is not None:
+        known = set(previous.failures)
+
+    return Summary(build, succeeded, failures,
+                   new_failures=[f.name for f in failures
+                                 if f.name not in known],
+                   fixed=sorted(known - names), log=log.strip())
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import collections
+
+from . import results
+from .test_helper import unittest
+
+
+NOSE_OUTPUT = """\
+.F.E
+======================================================================
+ERROR: test_add (watson.core_test.TestServer)
+----------------------------------------------------------------------
+Traceback (most recent call last):
+  File "watson/core_test.py", line 10, in test_add
+    raise KeyError('x')
+KeyError: 'x'
+
+======================================================================
+FAIL: test_build (watson.core_test.TestProjectWatcher.test_build)
+----------------------------------------------------------------------
+Traceback (most recent call last):
+  File "watson/core_test.py", line 20, in test_build
+    self.assertEqual(1, 2)
+AssertionError: 1 != 2
+-------------------- >> begin captured logging << --------------------
+root: INFO: Build 0 of test
+--------------------- >> end captured logging << ---------------------
+
+----------------------------------------------------------------------
+Ran 4 tests in 0.010s
+
+FAILED (errors=1, failures=1)
+"""
+
+PYTEST_OUTPUT = """\
+tests/test_a.py::test_one PASSED                                    [ 33%]
+tests/test_a.py::test_two FAILED                                    [ 66%]
+tests/test_a.py::test_three PASSED                                  [100%]
+=========================== short test summary info ===========================
+FAILED tests/test_a.py::test_two - assert 1 == 2
+ERROR tests/test_b.py - ImportError: No module named b
+========================= 1 failed, 2 passed in 0.05s =========================
+"""
+
+PEP8_OUTPUT = """\
+watson/core.py:12:80: E501 line too long (82 > 79 characters)
+watson/core.py:40:1: W391 blank line at end of file
+"""
+
+Result = collections.namedtuple('Result', ['stdout', 'stderr'])
+
+
+class TestParseFailures(unittest.TestCase):
+
+    def test_unittest(self):
+        self.assertEqual(
+            [results.Failure('watson.core_test.TestServer.test_add',
+                             "KeyError: 'x'"),
+             results.Failure(
+                 'watson.core_test.TestProjectWatcher.test_build',
+                 'AssertionError: 1 != 2')],
+            results.parse_failures(NOSE_OUTPUT))
+
+    def test_pytest(self):
+        self.assertEqual(
+            [results.Failure('tests/test_a.py::test_two', 'assert 1 == 2'),
+             results.Failure('tests/test_b.py',
+                             'ImportError: No module named b')],
+            results.parse_failures(PYTEST_OUTPUT))
+
+    def test_pep8(self):
+        self.assertEqual(
+            [results.Failure('watson/core.py: E501 #1',
+                             'line 12: line too long (82 > 79 characters)'),
+             results.Failure('watson/core.py: W391 #1',
+                             'line 40: blank line at end of file')],
+            results.parse_failures(PEP8_OUTPUT))
+
+    def test_pep8_repeated_violations(self):
+        output = '\n'.join(
+            ['a.py:%d:80: E501 line too long (%d > 79 characters)' % (n, n)
+             for n in range(80, 90)] +
+            ['a.py:%d:5: W291 trailing whitespace' % n for n in range(5)])
+
+        summary = results.summarize(1, False, Result(output, ''))
+
+        self.assertEqual(15, summary.failure_count)
+        self.assertEqual('a.py: E501 #10', summary.failures[9])
+        self.assertEqual('a.py: W291 #5', summary.failures[-1])
+
+    def test_unknown_output(self):
+        self.assertEqual([], results.parse_failures('FAILED (errors=3)'))
+
+
+class TestSummarize(unittest.TestCase):
+
+    def test_diff_with_previous_build(self):
+        previous = results.summarize(1, False, Result(PEP8_OUTPUT, ''))
+        output = PEP8_OUTPUT.splitlines()[0].replace(':12:', ':13:')
+
+        summary = results.summarize(2, False, Result('', output), previous)
+
+        self.assertEqual((), summary.new_failures)
+        self.assertEqual(('watson/core.py: W391 #1',), summary.fixed)
+
+    def test_new_failures(self):
+        previous = results.summarize(1, True, Result('OK', ''))
+
+        summary = results.summarize(2, False, Result(NOSE_OUTPUT, ''),
+                                    previous)
+
+        self.assertEqual(2, len(summary.new_failures))
+        self.assertEqual(
+            "new: watson.core_test.TestServer.test_add KeyError: 'x'",
+            summary.describe().splitlines()[0])
+        self.assertEqual('1 failing, 0 new, 1 fixed',
+                         results.summarize(3, False, Result(
+                             NOSE_OUTPUT.split('=' * 70)[1], ''),
+                             summary).describe().splitlines()[-1])
+
+    def test_compressed_log(self):
+        summary = results.summarize(1, False, Result(NOSE_OUTPUT, 'stderr'))
+
+        self.assertLess(len(summary._log), len(NOSE_OUTPUT))
+        self.assertEqual(NOSE_OUTPUT.strip() + '\nstderr', summary.log)
+
+    def test_bounded(self):
+        output = '\n'.join('tests/test_a.py::test_%d FAILED' % n
+                           for n in range(results.MAX_FAILURES + 10))
+        output += '\n' + 'x' * results.MAX_LOG_SIZE
+
+        summary = results.summarize(1, False, Result(output, ''))
+
+        self.assertEqual(results.MAX_FAILURES + 10, summary.failure_count)
+        self.assertEqual(results.MAX_FAILURES, len(summary.failures))
+        self.assertEqual('tests/test_a.py::test_0', summary.failures[0])
+        self.assertEqual(results.MAX_FAILURES, len(summary.new_failures))
+        self.assertEqual('x' * results.MAX_LOG_SIZE, summary.log)
+
+    def test_describe_without_failures(self):
+        summary = results.summarize(1, True, None)
+
+        self.assertEqual('', summary.describe())
+        self.assertEqual('', summary.log)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""Lightweight timing spans of the server's hot paths.
+
+Spans are sampled, so with a low sample rate they cost next to nothing, and
+kept in a bounded buffer. Use `profile` to trace every span for a while.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import random
+import threading
+import time
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+    def __init__(self, tracer, name):
+        self._tracer = tracer
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._tracer.record(self._name, self._start,
+                            time.time() - self._start)
+        return False
+
+
+class Tracer(object):
+    """Collects sampled spans and aggregated statistics per span name."""
+
+    def __init__(self, sample_rate=0.0, size=1000):
+        self.sample_rate = sample_rate
+        self._spans = collections.deque(maxlen=size)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def configure(self, sample_rate, size):
+        with self._lock:
+            self.sample_rate = sample_rate
+            self._spans = collections.deque(self._spans, maxlen=size)
+
+    def span(self, name):
+        """Returns a context manager measuring a (sampled) span."""
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return _NULL_SPAN
+
+        return _Span(self, name)
+
+    def record(self, name, start, duration):
+        with self._lock:
+            self._spans.append((name, start, duration))
+
+            stats = self._stats.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+
+    def reset(self):
+        with self._lock:
+            self._spans.clear()
+            self._stats.clear()
+
+    def dump(self):
+        """Returns recorded spans and statistics as plain data."""
+        with self._lock:
+            stats = dict((name, {'count': count, 'total': total,
+                                 'mean': total / count, 'max': maximum})
+                         for name, (count, total, maximum)
+                         in self._stats.iteritems())
+            spans = [{'name': name, 'start': start, 'duration': duration}
+                     for name, start, duration in self._spans]
+
+        return {'sample_rate': self.sample_rate, 'stats': stats,
+                'spans': spans}
+
+    def profile(self, seconds):
+        """Traces every span for given time and returns the dump."""
+        sample_rate = self.sample_rate
+        self.reset()
+        self.sample_rate = 1.0
+        try:
+            time.sleep(seconds)
+            return self.dump()
+        finally:
+            self.sample_rate = sample_rate
+
+
+tracer = Tracer()
+span = tracer.span
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+from . import trace
+from .test_helper import unittest
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_disabled(self):
+        tracer = trace.Tracer(sample_rate=0)
+
+        with tracer.span('dispatch'):
+            pass
+
+        self.assertEqual({}, tracer.dump()['stats'])
+
+    def test_span(self):
+        tracer = trace.Tracer(sample_rate=1)
+
+        for _ in range(3):
+            with tracer.span('dispatch'):
+                pass
+
+        stats = tracer.dump()['stats']
+        self.assertEqual(['dispatch'], stats.keys())
+        self.assertEqual(3, stats['dispatch']['count'])
+
+    def test_buffer_is_bounded(self):
+        tracer = trace.Tracer(sample_rate=1, size=2)
+
+        for name in ['a', 'b', 'c']:
+            tracer.record(name, 0, 1)
+
+        self.assertEqual(['b', 'c'],
+                         [s['name'] for s in tracer.dump()['spans']])
+        self.assertEqual(3, len(tracer.dump()['stats']))
+
+    def test_profile_restores_sample_rate(self):
+        tracer = trace.Tracer(sample_rate=0.5)
+        tracer.record('old', 0, 1)
+
+        dump = tracer.profile(0)
+
+        self.assertEqual(1.0, dump['sample_rate'])
+        self.assertEqual([], dump['spans'])
+        self.assertEqual(0.5, tracer.sample_rate)
+
+
+if __name__ == '__main__':
+    unittest.main()
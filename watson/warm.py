@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+"""Warm interpreters for repeated runs of Python test commands.
+
+A zygote process imports project dependencies once and then forks a fresh
+child for every command it is asked to run, so builds do not pay for the
+interpreter startup and heavy imports each time.
+
+This module is also executed as a standalone script by the project's
+interpreter (which may be a different one than watson runs on), so the
+zygote part must only use the standard library.
+"""
+
+from __future__ import absolute_import
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import traceback
+
+
+ZYGOTE_SCRIPT = os.path.abspath(__file__).replace('.pyc', '.py')
+
+# Files that define a dependency set of a project
+DEPENDENCY_FILES = ['setup.py', 'setup.cfg', 'requirements*.txt']
+
+# Commands containing these are left to the shell
+SHELL_CHARACTERS = set('|&;<>()$`\\"\'*?[]#~')
+
+
+class WarmRunnerError(Exception):
+    pass
+
+
+def dependency_fingerprint(working_dir, imports):
+    """Returns a digest of the project's dependency set.
+
+    Args:
+        working_dir: a project directory
+        imports: a list of modules imported by the zygote
+    """
+    digest = hashlib.sha1(repr(sorted(imports)).encode('utf-8'))
+
+    for pattern in DEPENDENCY_FILES:
+        for filename in sorted(glob.glob(os.path.join(working_dir, pattern))):
+            with open(filename, 'rb') as f:
+                digest.update(filename.encode('utf-8'))
+                digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def _which(executable):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(directory, executable)
+        if os.path.isfile(candidate):
+            return candidate
+
+
+def parse_command(working_dir, command):
+    """Checks if a command runs a Python script that can be run warm.
+
+    Returns:
+        An (interpreter, script, argv) tuple or None if the command has to be
+        executed by the shell.
+    """
+    if SHELL_CHARACTERS.intersection(command):
+        return None
+
+    argv = shlex.split(command)
+    if not argv:
+        return None
+
+    if os.sep in argv[0]:
+        script = os.path.join(working_dir, argv[0])
+    else:
+        script = _which(argv[0])
+
+    if script is None or not os.path.isfile(script):
+        return None
+
+    with open(script, 'rb') as f:
+        shebang = f.readline().decode('utf-8', 'replace').strip()
+
+    if not shebang.startswith('#!') or 'python' not in shebang:
+        return None
+
+    interpreter = shebang[2:].split()
+    if os.path.basename(interpreter[0]) == 'env':
+        interpreter = interpreter[1:]
+
+    if len(interpreter) != 1:
+        return None
+
+    return interpreter[0], os.path.abspath(script), argv
+
+
+class WarmRunner(object):
+    """Client of a zygote process running in a project directory."""
+
+    def __init__(self, working_dir, interpreter, imports):
+        self.working_dir = working_dir
+        self.interpreter = interpreter
+        self.fingerprint = dependency_fingerprint(working_dir, imports)
+
+        logging.info('Starting warm runner for %s', working_dir)
+        self._process = subprocess.Popen(
+            [interpreter, ZYGOTE_SCRIPT, working_dir] + list(imports),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=working_dir)
+        self._receive()
+
+    @property
+    def is_alive(self):
+        return self._process.poll() is None
+
+    def run(self, script, argv):
+        """Runs a script in a forked child of the zygote.
+
+        Returns:
+            A (return_code, stdout, stderr) tuple, with outputs encoded in
+            UTF-8 as the ones of operations.local
+        """
+        request = json.dumps({'script': script, 'argv': argv})
+        try:
+            self._process.stdin.write(request.encode('utf-8') + b'\n')
+            self._process.stdin.flush()
+        except (IOError, OSError) as e:
+            raise WarmRunnerError('warm runner is gone: %s' % e)
+
+        response = self._receive()
+        return (response['code'], response['stdout'].encode('utf-8'),
+                response['stderr'].encode('utf-8'))
+
+    def close(self):
+        if self.is_alive:
+            logging.info('Stopping warm runner for %s', self.working_dir)
+            self._process.stdin.close()
+            self._process.wait()
+
+    def _receive(self):
+        line = self._process.stdout.readline()
+        if not line:
+            raise WarmRunnerError('warm runner for %s exited with %s' % (
+                self.working_dir, self._process.wait()))
+
+        return json.loads(line.decode('utf-8'))
+
+
+# Modules under these are third-party ones, even inside of the project
+THIRD_PARTY_DIRECTORIES = set(['site-packages', 'dist-packages'])
+
+
+def _is_project_module(working_dir, filename):
+    if not filename.startswith(working_dir + os.sep):
+        return False
+
+    parts = filename[len(working_dir):].split(os.sep)
+    return not THIRD_PARTY_DIRECTORIES.intersection(parts)
+
+
+def _drop_project_modules(working_dir):
+    """Removes modules loaded from the project, so the run imports them anew.
+
+    Only third-party modules stay warm. Otherwise modules importing a changed
+    one would keep its old objects. Modules whose source file is gone are
+    made unimportable, so they are not loaded from stale bytecode.
+    """
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, '__file__', None)
+        if not filename:
+            continue
+
+        filename = os.path.abspath(filename)
+        if not _is_project_module(working_dir, filename):
+            continue
+
+        if filename.endswith(('.pyc', '.pyo')):
+            filename = filename[:-1]
+
+        if os.path.exists(filename):
+            del sys.modules[name]
+        else:
+            sys.modules[name] = None
+
+
+def _run_child(script, argv):
+    import runpy
+
+    sys.argv = argv
+    code = 0
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            sys.stderr.write('%s\n' % e.code)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return code
+
+
+def _fork(working_dir, request):
+    outputs = [tempfile.TemporaryFile(), tempfile.TemporaryFile()]
+
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            os.dup2(outputs[0].fileno(), 1)
+            os.dup2(outputs[1].fileno(), 2)
+            _drop_project_modules(working_dir)
+            code = _run_child(request['script'], request['argv'])
+        finally:
+            os._exit(code)
+
+    _, status = os.waitpid(pid, 0)
+    code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+
+    result = {'code': code}
+    for name, output in zip(['stdout', 'stderr'], outputs):
+        output.seek(0)
+        result[name] = output.read().decode('utf-8', 'replace').strip()
+        output.close()
+
+    return result
+
+
+def main(argv):
+    """Zygote loop: imports given modules and serves run requests."""
+    working_dir, imports = os.path.abspath(argv[1]), argv[2:]
+
+    # Imported code may print things, so keep the protocol on its own fd
+    protocol = os.fdopen(os.dup(1), 'w')
+    os.dup2(2, 1)
+
+    # Do not let watson's own modules shadow the project ones
+    os.chdir(working_dir)
+    sys.path[0] = working_dir
+    for name in imports:
+        try:
+            __import__(name)
+        except Exception:
+            traceback.print_exc()
+
+    protocol.write(json.dumps({'ready': True}) + '\n')
+    protocol.flush()
+
+    for line in iter(sys.stdin.readline, ''):
+        response = _fork(working_dir, json.loads(line))
+        protocol.write(json.dumps(response) + '\n')
+        protocol.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
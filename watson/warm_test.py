@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+import path
+import shutil
+import sys
+import tempfile
+import time
+
+from . import core
+from . import warm
+from .test_helper import unittest
+
+
+class TestParseCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.working_dir = path.path(tempfile.mkdtemp())
+
+        self.script = self.working_dir / 'runtests'
+        self.script.write_text('#!%s\nimport lib\nprint(lib.VALUE)\n'
+                               % sys.executable)
+
+    def tearDown(self):
+        shutil.rmtree(self.working_dir)
+
+    def test_python_script(self):
+        self.assertEqual(
+            (sys.executable, self.script, ['./runtests', '-v']),
+            warm.parse_command(self.working_dir, './runtests -v'))
+
+    def test_shell_command(self):
+        self.assertIsNone(
+            warm.parse_command(self.working_dir, './runtests | grep OK'))
+
+    def test_not_a_python_script(self):
+        (self.working_dir / 'run.sh').write_text('#!/bin/sh\necho 1\n')
+
+        self.assertIsNone(warm.parse_command(self.working_dir, './run.sh'))
+
+    def test_fingerprint_follows_requirements(self):
+        fingerprint = warm.dependency_fingerprint(self.working_dir, [])
+        (self.working_dir / 'requirements.txt').write_text('nose\n')
+
+        self.assertNotEqual(
+            fingerprint, warm.dependency_fingerprint(self.working_dir, []))
+
+
+class TestWarmRunner(TestParseCommand):
+
+    def setUp(self):
+        super(TestWarmRunner, self).setUp()
+
+        self.lib = self.working_dir / 'lib.py'
+        self.lib.write_text('VALUE = 1\n')
+        self.runner = warm.WarmRunner(self.working_dir, sys.executable,
+                                      ['lib'])
+
+    def tearDown(self):
+        self.runner.close()
+        super(TestWarmRunner, self).tearDown()
+
+    def test_run(self):
+        self.assertEqual((0, '1', ''),
+                         self.runner.run(self.script, ['runtests']))
+
+    def test_run_reloads_changed_modules(self):
+        self.lib.write_text('VALUE = 2\n')
+        mtime = time.time() + 10
+        self.lib.utime((mtime, mtime))
+
+        self.assertEqual((0, '2', ''),
+                         self.runner.run(self.script, ['runtests']))
+
+    def start_package_runner(self):
+        package = self.working_dir / 'pkg'
+        package.mkdir()
+        (package / '__init__.py').write_text('')
+        (package / 'core.py').write_text('VALUE = 1\n')
+        (package / 'api.py').write_text('from pkg.core import VALUE\n')
+        self.script.write_text('import pkg.api\nprint(pkg.api.VALUE)\n')
+
+        self.runner.close()
+        self.runner = warm.WarmRunner(self.working_dir, sys.executable,
+                                      ['pkg.api'])
+        return package
+
+    def test_run_reloads_importers_of_changed_modules(self):
+        package = self.start_package_runner()
+        (package / 'core.py').write_text('VALUE = 2\n')
+        mtime = time.time() + 10
+        (package / 'core.py').utime((mtime, mtime))
+
+        self.assertEqual((0, '2', ''),
+                         self.runner.run(self.script, ['runtests']))
+
+    def test_run_fails_when_module_is_deleted(self):
+        package = self.start_package_runner()
+        (package / 'api.py').remove()
+
+        code, _, stderr = self.runner.run(self.script, ['runtests'])
+
+        self.assertEqual(1, code)
+        self.assertIn('ImportError', stderr)
+
+    def test_run_non_ascii_output(self):
+        self.script.write_text(
+            "import sys\nsys.stdout.write(u'caf\\xe9'.encode('utf-8'))\n")
+
+        code, stdout, _ = self.runner.run(self.script, ['runtests'])
+
+        self.assertEqual('caf\xc3\xa9', stdout)
+        self.assertIsInstance(stdout, str)
+        self.assertEqual(stdout, core.make_result('runtests', code, stdout,
+                                                  ''))
+
+    def test_run_failure(self):
+        self.script.write_text('import sys\nsys.exit(3)\n')
+
+        self.assertEqual((3, '', ''),
+                         self.runner.run(self.script, ['runtests']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+
+"""Worker agents that run builds on behalf of a watson server.
+
+A worker agent keeps mirrors of project sources, which are synced
+incrementally by WorkerClient, runs build scripts in them and streams their
+output back.
+"""
+
+from __future__ import absolute_import
+
+import itertools
+import logging
+import os
+import path
+import shutil
+import SimpleXMLRPCServer
+import subprocess
+import threading
+import time
+import xmlrpclib
+import zlib
+
+
+# Rough upper limit of file contents sent in a single sync call
+SYNC_BATCH_SIZE = 4 * 1024 * 1024
+
+# How often output of a running build is polled
+POLL_INTERVAL = 0.2
+
+
+class WorkerError(Exception):
+    pass
+
+
+def get_project_key(working_dir):
+    """Returns a name of the project's mirror directory on a worker."""
+    working_dir = path.path(working_dir).abspath()
+    return '%s-%08x' % (working_dir.name,
+                        zlib.crc32(working_dir.encode('utf-8')) & 0xffffffff)
+
+
+class _Build(object):
+
+    def __init__(self, directory, script, output_prefix):
+        self.stdout_file = output_prefix + '.out'
+        self.stderr_file = output_prefix + '.err'
+        self.return_code = None
+
+        # Files are created before polling can start
+        out = open(self.stdout_file, 'w')
+        err = open(self.stderr_file, 'w')
+        self._thread = threading.Thread(target=self._run,
+                                        args=(directory, script, out, err))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def is_finished(self):
+        return self.return_code is not None
+
+    def _run(self, directory, script, out, err):
+        return_code = 0
+        with out:
+            with err:
+                for command in script:
+                    return_code = subprocess.call(
+                        command, shell=True, cwd=directory,
+                        stdout=out, stderr=err)
+                    if return_code != 0:
+                        break
+
+        self.return_code = return_code
+
+    def read(self, stdout_offset, stderr_offset):
+        chunks = []
+        for filename, offset in [(self.stdout_file, stdout_offset),
+                                 (self.stderr_file, stderr_offset)]:
+            with open(filename) as f:
+                f.seek(offset)
+                chunks.append(f.read())
+
+        return chunks
+
+    def remove(self):
+        for filename in [self.stdout_file, self.stderr_file]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+class WorkerAgent(object):
+    """XMLRPC server which runs builds in mirrors of project sources."""
+
+    def __init__(self, endpoint, root):
+        logging.info('Starting worker agent in %s', root)
+
+        self.endpoint = endpoint
+        self._root = path.path(root)
+        self._builds_dir = self._root / '.builds'
+        self._builds_dir.makedirs_p()
+
+        self._builds = {}
+        self._build_ids = itertools.count(1)
+
+        self._api = SimpleXMLRPCServer.SimpleXMLRPCServer(
+            endpoint, allow_none=True, logRequests=False)
+        self._api.register_instance(self)
+
+    def _start(self):
+        logging.info('Worker listening on %s', self.endpoint)
+        self._api.serve_forever()
+
+    def _join(self):
+        self._api.shutdown()
+
+    def _project_dir(self, project):
+        directory = (self._root / project).normpath()
+        if directory.parent != self._root or project.startswith('.'):
+            raise WorkerError('invalid project: %r' % project)
+
+        return directory
+
+    def _file_path(self, project, relative_path):
+        project_dir = self._project_dir(project)
+        filename = (project_dir / relative_path).normpath()
+        if not filename.startswith(project_dir + '/'):
+            raise WorkerError('invalid path: %r' % relative_path)
+
+        return filename
+
+    def hello(self):
+        return 'Watson worker'
+
+    def load(self):
+        """Returns the number of running builds."""
+        return sum(1 for b in self._builds.itervalues() if not b.is_finished)
+
+    def reset(self, project):
+        """Removes the project's mirror, before it is synced from scratch."""
+        project_dir = self._project_dir(project)
+        if project_dir.exists():
+            shutil.rmtree(project_dir)
+
+    def sync(self, project, files, removed):
+        """Updates the project's mirror.
+
+        Args:
+            project: a project key
+            files: a dict of relative paths and their contents (as Binary)
+            removed: a list of relative paths to remove
+        """
+        for relative_path in removed:
+            filename = self._file_path(project, relative_path)
+            if filename.isdir():
+                shutil.rmtree(filename)
+            elif filename.exists():
+                filename.remove()
+
+        for relative_path, content in files.iteritems():
+            filename = self._file_path(project, relative_path)
+            filename.parent.makedirs_p()
+            filename.write_bytes(content.data)
+
+    def build(self, project, script):
+        """Starts a build and returns its id."""
+        project_dir = self._project_dir(project)
+        project_dir.makedirs_p()
+
+        build_id = next(self._build_ids)
+        logging.info('Build %s of %s', build_id, project)
+        self._builds[build_id] = _Build(project_dir, script,
+                                        self._builds_dir / str(build_id))
+        return build_id
+
+    def poll(self, build_id, stdout_offset=0, stderr_offset=0):
+        """Returns output of a build since given offsets.
+
+        Once a finished build is polled, it is forgotten.
+        """
+        build = self._builds.get(build_id)
+        if build is None:
+            raise WorkerError('unknown build: %s' % build_id)
+
+        return_code = build.return_code
+        stdout, stderr = build.read(stdout_offset, stderr_offset)
+
+        if return_code is not None:
+            del self._builds[build_id]
+            build.remove()
+
+        return {'stdout': xmlrpclib.Binary(stdout),
+                'stderr': xmlrpclib.Binary(stderr),
+                'return_code': return_code}
+
+    def shutdown(self):
+        logging.info('Shuting down')
+        self._api.server_close()
+
+
+def _expand(working_dir, paths, is_ignored):
+    """Yields given relative paths, with directories replaced by their files.
+
+    Files of a directory (e.g. moved into a project) are filtered as in
+    ProjectWatcher.list_files, and directories which do not exist any more
+    are yielded as they are, so they get removed.
+    """
+    for relative_path in sorted(unicode(p) for p in paths):
+        directory = working_dir / relative_path
+        if not directory.isdir():
+            yield relative_path
+            continue
+
+        for root, dirs, files in os.walk(directory):
+            relative_root = unicode(working_dir.relpathto(root))
+            dirs[:] = [d for d in dirs if not is_ignored(
+                os.path.join(relative_root, d) + '/')]
+
+            for name in files:
+                relative = os.path.join(relative_root, name)
+                if not is_ignored(relative):
+                    yield relative
+
+
+class WorkerClient(object):
+    """Sends builds to a worker agent and keeps its mirrors in sync."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<WorkerClient %s>' % self.endpoint
+
+    def call(self, method, *args):
+        # ServerProxy is not thread-safe, so each call gets its own
+        proxy = xmlrpclib.ServerProxy('http://%s/' % self.endpoint,
+                                      allow_none=True)
+        return getattr(proxy, method)(*args)
+
+    def load(self):
+        return self.call('load')
+
+    def add_pending(self, working_dir, paths):
+        """Remembers changes which this worker has not received yet."""
+        working_dir = path.path(working_dir)
+        with self._lock:
+            if working_dir in self._pending:
+                self._pending[working_dir].update(paths)
+
+    def sync(self, working_dir, changes, list_files, is_ignored):
+        """Sends changed files (or all of them, on first sync) to the worker.
+
+        Args:
+            working_dir: a project directory
+            changes: a set of relative paths changed since last build
+            list_files: a function returning all files of the project
+            is_ignored: a function checking if a relative path is ignored
+        """
+        working_dir = path.path(working_dir)
+        project = get_project_key(working_dir)
+
+        with self._lock:
+            pending = self._pending.pop(working_dir, None)
+
+        if pending is None:
+            logging.info('Full sync of %s to %r', working_dir, self)
+            self.call('reset', project)
+            paths = set(list_files())
+        else:
+            paths = pending | set(changes)
+
+        # If sending fails, the next sync starts from scratch
+        self._send(project, working_dir, paths, is_ignored)
+        with self._lock:
+            self._pending[working_dir] = set()
+
+    def _send(self, project, working_dir, paths, is_ignored):
+        files, removed, size = {}, [], 0
+
+        for relative_path in _expand(working_dir, paths, is_ignored):
+            filename = working_dir / relative_path
+            if filename.isfile():
+                files[relative_path] = xmlrpclib.Binary(filename.bytes())
+                size += len(files[relative_path].data)
+            else:
+                removed.append(relative_path)
+
+            if size >= SYNC_BATCH_SIZE:
+                self.call('sync', project, files, removed)
+                files, removed, size = {}, [], 0
+
+        if files or removed:
+            self.call('sync', project, files, removed)
+
+    def execute(self, working_dir, script, on_output=None):
+        """Runs a script on the worker, streaming its output.
+
+        Returns:
+            A (return_code, stdout, stderr) tuple
+        """
+        build_id = self.call('build', get_project_key(working_dir), script)
+
+        stdout, stderr = [], []
+        while True:
+            result = self.call('poll', build_id, sum(map(len, stdout)),
+                               sum(map(len, stderr)))
+            for chunks, chunk in [(stdout, result['stdout'].data),
+                                  (stderr, result['stderr'].data)]:
+                if chunk:
+                    chunks.append(chunk)
+                    if on_output is not None:
+                        on_output(chunk)
+
+            if result['return_code'] is not None:
+                return (result['return_code'], ''.join(stdout).strip(),
+                        ''.join(stderr).strip())
+
+            time.sleep(POLL_INTERVAL)
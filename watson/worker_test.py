@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+import os
+import path
+import Queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import xmlrpclib
+
+from . import core
+from . import worker
+from .test_helper import unittest
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestWorkerAgent(unittest.TestCase):
+
+    def setUp(self):
+        self.root = path.path(tempfile.mkdtemp())
+        self.agent = worker.WorkerAgent(('localhost', free_port()), self.root)
+
+    def tearDown(self):
+        self.agent.shutdown()
+        shutil.rmtree(self.root)
+
+    def wait_for(self, build_id):
+        while True:
+            result = self.agent.poll(build_id)
+            if result['return_code'] is not None:
+                return result
+            time.sleep(0.01)
+
+    def test_sync_and_build(self):
+        self.agent.sync('project', {'a/b.txt': xmlrpclib.Binary('content')},
+                        [])
+        build_id = self.agent.build('project', ['cat a/b.txt', 'echo x >&2'])
+
+        result = self.wait_for(build_id)
+
+        self.assertEqual(0, result['return_code'])
+        self.assertEqual('content', result['stdout'].data)
+        self.assertEqual('x\n', result['stderr'].data)
+        self.assertEqual(0, self.agent.load())
+
+    def test_failed_command_stops_the_script(self):
+        build_id = self.agent.build('project', ['exit 3', 'echo never'])
+
+        result = self.wait_for(build_id)
+
+        self.assertEqual(3, result['return_code'])
+        self.assertEqual('', result['stdout'].data)
+
+    def test_sync_removes_files(self):
+        self.agent.sync('project', {'a.txt': xmlrpclib.Binary('')}, [])
+        self.agent.sync('project', {}, ['a.txt'])
+
+        self.assertFalse((self.root / 'project' / 'a.txt').exists())
+
+    def test_rejects_paths_outside_of_the_mirror(self):
+        for project, relative_path in [('project', '../evil'),
+                                       ('project', '/etc/evil'),
+                                       ('../project', 'a'),
+                                       ('.builds', 'a')]:
+            self.assertRaises(worker.WorkerError, self.agent.sync, project,
+                              {relative_path: xmlrpclib.Binary('')}, [])
+
+
+class TestExpand(unittest.TestCase):
+
+    def setUp(self):
+        self.project = path.path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.project)
+
+    def test_directories_are_replaced_by_not_ignored_files(self):
+        (self.project / 'moved' / '.git').makedirs()
+        (self.project / 'moved' / '.git' / 'index').write_text('')
+        (self.project / 'moved' / 'module.py').write_text('')
+        (self.project / 'moved' / 'module.pyc').write_text('')
+
+        def is_ignored(relative_path):
+            return relative_path.endswith(('.pyc', '.git/'))
+
+        self.assertEqual(
+            ['gone', 'moved/module.py', 'setup.py'],
+            list(worker._expand(self.project,
+                                set(['setup.py', 'moved', 'gone']),
+                                is_ignored)))
+
+
+class RemoteProjectMock(object):
+    priority = 0
+    last_changed = 0
+    name = 'project'
+
+    def __init__(self, builder, working_dir, command):
+        working_dir.mkdir()
+        self.builder = builder
+        self.working_dir = working_dir
+        self.command = command
+        self.status = None
+
+    def build(self):
+        changes = core.Changes(lambda: [], lambda relative_path: False)
+        self.status = self.builder.execute_script(
+            self.working_dir, [self.command], False, changes)
+
+
+class TestRemoteBuilder(unittest.TestCase):
+    """Builds on worker agents running as separate processes."""
+
+    def setUp(self):
+        self.home = path.path(tempfile.mkdtemp())
+        self.project = self.home / 'project'
+        self.project.mkdir()
+        (self.project / 'module.txt').write_text('first')
+
+        self.local_builder = core.ProjectBuilder()
+        self.builder = core.RemoteBuilder(self.local_builder)
+        self.agents = []
+
+    def tearDown(self):
+        for process in self.agents:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+
+        self.builder.shutdown()
+        shutil.rmtree(self.home)
+
+    def start_agent(self):
+        endpoint = 'localhost:%d' % free_port()
+        python_path = os.path.dirname(os.path.dirname(core.__file__))
+        # Agents would share their mirrors in the same home
+        home = self.home / ('agent%d' % len(self.agents))
+        env = dict(os.environ, HOME=home, PYTHONPATH=python_path)
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'watson.client', 'worker', endpoint],
+            env=env)
+        self.agents.append(process)
+
+        client = worker.WorkerClient(endpoint)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                client.call('hello')
+                break
+            except socket.error:
+                time.sleep(0.1)
+
+        self.builder.register(endpoint)
+        return process
+
+    def build(self, *changed):
+        changes = core.Changes(
+            lambda: [self.project.relpathto(f)
+                     for f in self.project.walkfiles()],
+            lambda relative_path: relative_path.endswith('.pyc'))
+        changes.paths.update(changed)
+        return self.builder.execute_script(self.project, ['cat module.txt'],
+                                           False, changes)
+
+    def test_builds_on_a_worker(self):
+        self.start_agent()
+
+        succeeded, result = self.build()
+        self.assertTrue(succeeded)
+        self.assertEqual('first', result)
+
+        (self.project / 'module.txt').write_text('second')
+        succeeded, result = self.build('module.txt')
+        self.assertEqual('second', result)
+
+    def test_workers_get_missed_changes(self):
+        self.start_agent()
+        self.start_agent()
+
+        # Make sure both workers have done a full sync
+        for client in self.builder._workers.values():
+            client.sync(self.project, set(), lambda: ['module.txt'],
+                        lambda relative_path: False)
+
+        for content in ['2', '3', '4', '5', '6', '7']:
+            (self.project / 'module.txt').write_text(content)
+            self.assertEqual((True, content), self.build('module.txt'))
+
+    def test_builds_projects_in_parallel(self):
+        self.start_agent()
+        self.start_agent()
+
+        # Each build waits until the other one has started
+        projects = []
+        for name, other in [('a', 'b'), ('b', 'a')]:
+            project = RemoteProjectMock(
+                self.builder, self.home / name,
+                'touch %s; for i in $(seq 100); do test -e %s && exit 0; '
+                'sleep 0.1; done; exit 1' % (self.home / (name + '.started'),
+                                             self.home / (other + '.started')))
+            projects.append(project)
+
+        built = Queue.Queue()
+        queue = core.BuildQueue(built.put, self.builder.capacity)
+        queue.start()
+        try:
+            for project in projects:
+                queue.put(project)
+            finished = [built.get(timeout=30), built.get(timeout=30)]
+        finally:
+            queue.stop()
+            queue.join()
+
+        self.assertEqual(set(projects), set(finished))
+        for project in projects:
+            self.assertTrue(project.status[0])
+            self.assertIsNot(project.status[1], None)
+        self.assertEqual(0, sum(self.builder._in_flight.values()))
+
+    def test_falls_back_to_local_build(self):
+        agent = self.start_agent()
+        agent.terminate()
+        agent.wait()
+
+        succeeded, result = self.build()
+
+        self.assertTrue(succeeded)
+        self.assertEqual('first', result)